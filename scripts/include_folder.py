@@ -1,3 +1,4 @@
+from multiprocessing import Pool
 from optparse import OptionParser
 
 import os
@@ -19,6 +20,9 @@ parser.add_option("-f", "--folder", dest="folders", action="append")
 parser.add_option("-c", "--commit", dest="commit", action="store_true", default=False)
 parser.add_option("--invalidate", dest="invalidate", action="store_true", default=False)
 
+parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                  help="Number of processes reading package headers (default: CPU count)")
+
 parser.add_option("--repo-path", dest="repo_path", default="/mnt/storage/repos/smd-ros-building/fedora")
 
 (options, args) = parser.parse_args()
@@ -27,17 +31,39 @@ for f in options.folders:
     if not os.path.isdir(f):
         parser.error("Folder option must be a folder: %s" % f)
 
+def find_rpms(folders):
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                if file.endswith(".rpm"):
+                    yield os.path.join(root, file)
+
+# read headers in parallel, collecting them as they come in
 new_rpms = set()
-for folder in options.folders:
-    for root, dirs, files in os.walk(folder):
-        for file in files:
-            if file.endswith(".rpm"):
-                new_rpms.add(rpminfo.read_from_rpm(os.path.join(root, file)))
+pool = Pool(options.jobs)
+try:
+    for pkg in pool.imap_unordered(rpminfo.read_from_rpm, find_rpms(options.folders), 4):
+        new_rpms.add(pkg)
+    pool.close()
+except:
+    pool.terminate()
+    raise
+finally:
+    pool.join()
 
 if not new_rpms:
     parser.error("Folders %s doesn't contain any RPM files. %s" %
                  (options.folders, [os.listdir(f) for f in options.folders]))
 
+# refuse uploads which can't be placed before touching the repository
+unplaceable = set()
+for (distro, distver), pkgs in rpminfo.classify_releases(new_rpms).items():
+    if distro != 'fc':
+        unplaceable |= pkgs
+if unplaceable:
+    parser.error("Non-Fedora release tag on package(s): %s" %
+                 ', '.join(sorted(str(pkg.path) for pkg in unplaceable)))
+
 lockfile = os.path.join(options.repo_path, 'lock')
 pkgcache = {}
 
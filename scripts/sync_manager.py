@@ -28,12 +28,15 @@ def is_dir_writeable(path):
 parser.add_argument('--arches', dest='arch', nargs='+', help='Architecture(s) to sync', choices=possible_arches)
 parser.add_argument('--commit', dest='commit', action='store_true', default=False, help='Actually perform sync')
 parser.add_argument('--hardlink', dest='hardlink', action='store_true', default=False, help='Perform a hard link instead of copy')
+parser.add_argument('--reflink', dest='reflink', action='store_true', default=False, help='Perform a copy-on-write clone instead of copy')
 parser.add_argument('--release', dest='release', nargs='+', type=int, help='Fedora release(s) to sync')
 parser.add_argument('--debug', dest='debug', action='store_true', default=False, help='Verbose output')
-parser.add_argument('--fast', dest='fast', action='store_true', default=False, help='Look for shortcuts to speed-up the sync')
+parser.add_argument('--fast', dest='fast', action='store_true', default=False, help='Skip packages which are identical in source and destination')
 parser.add_argument('--verify-exist', dest='verify_exist', action='store_true', default=False, help='Verify existence packages in destination repo and remove when absent')
 parser.add_argument('--sign', dest='sign', action='store_true', default=False, help='Sign packages as they are added to the repository')
 parser.add_argument('--filter', dest='filter', default='', help='Package filter (regex allowed)')
+parser.add_argument('--io-jobs', dest='io_jobs', type=int, default=createrepo_updater.io_workers, help='Number of packages to copy concurrently (default: %(default)s)')
+parser.add_argument('--jobs', dest='jobs', type=int, default=None, help='Maximum number of processes used to parse and generate metadata (default: number of cores)')
 
 # Commands
 parser.add_argument('--clean', dest='clean', action='store_true', default=False, help='Remove packages matching the filter from the repo')
@@ -60,6 +63,9 @@ def parse_args():
     if os.path.normpath(args.source_repo) == os.path.normpath(args.dest_repo):
         parser.error('source_repo and dest_repo must be different')
 
+    if args.hardlink and args.reflink:
+        parser.error('--hardlink and --reflink are mutually exclusive')
+
     if args.sign:
         if args.hardlink:
             wrn('hardlinking is not possible when signing packages. Disabling hardlinking...')
@@ -68,11 +74,6 @@ def parse_args():
             wrn('hardlinking is only possible with the --update command. Disabling hardlinking...')
             args.hardlink = False
 
-    if args.fast:
-        if not args.clean or not args.update:
-            wrn('fast option is only possible with both --clean and --update. Disabling fast...')
-            args.fast = False
-
     if not args.debug:
         global dbg
         global dbghandle
@@ -89,7 +90,7 @@ def parse_args():
 
     return args
 
-def load_repo(path, releases=[], arches=[]):
+def load_repo(path, releases=[], arches=[], primary_only=False, processes=None):
     ret = dict()
 
     if not releases:
@@ -104,6 +105,8 @@ def load_repo(path, releases=[], arches=[]):
         for release in oldrel:
             releases += ['{0}'.format(release)]
 
+    archpaths = dict()
+
     for release in releases:
         ret[release] = dict()
         relarches = arches
@@ -122,13 +125,64 @@ def load_repo(path, releases=[], arches=[]):
             if not arch in possible_arches:
                 dbg('Ignoring invalid arch dir \'{0}\''.format(archpath))
                 continue
-            ret[release][arch] = createrepo_updater.cr_get_pkg_list(archpath, log=dbghandle)
+            archpaths[archpath] = (release, arch)
+
+    pkglists = createrepo_updater.cr_get_all_pkg_list(archpaths.keys(), primary_only=primary_only, processes=processes, log=dbghandle)
+    for (archpath, (release, arch)) in archpaths.items():
+        ret[release][arch] = pkglists[archpath]
 
     return ret
 
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    return '{0:.1f} {1}'.format(size, unit)
+
+def skip_unchanged(dest_path, dest_repo, staged_for_removal, staged_for_update):
+    skipped = 0
+    saved = 0
+
+    for rel in staged_for_update.keys():
+        for arch in staged_for_update[rel].keys():
+            if not arch in dest_repo.get(rel, {}):
+                continue
+            tgtpath = os.path.join(dest_path, rel, arch)
+            by_name = createrepo_updater.cr_get_pkg_index(tgtpath, dest_repo[rel][arch], log=dbghandle)['name']
+            for (name, pkg) in staged_for_update[rel][arch].items():
+                # Only a lone, identical package which is actually on disk
+                # can stay. Anything else needs the full remove and copy.
+                existing = by_name.get(name, ())
+                if len(existing) != 1:
+                    continue
+                existing = iter(existing).next()
+                if existing.pkgId != pkg.pkgId or not os.path.isfile(os.path.join(tgtpath, existing.location_href)):
+                    continue
+                dbg('Package \'{0}\' is same in source and destination. Skipping...'.format(name))
+                skipped += 1
+                saved += pkg.size_package or 0
+                del staged_for_update[rel][arch][name]
+                if rel in staged_for_removal and arch in staged_for_removal[rel]:
+                    staged_for_removal[rel][arch].pop(name, None)
+
+    for staged in [staged_for_removal, staged_for_update]:
+        for rel in staged.keys():
+            for arch in staged[rel].keys():
+                if not staged[rel][arch]:
+                    del staged[rel][arch]
+            if not staged[rel]:
+                del staged[rel]
+
+    return (skipped, saved)
+
 def main(args):
     nfo('Starting repository operations...')
 
+    createrepo_updater.io_workers = args.io_jobs
+
     filter = re.compile(args.filter)
     dbg('Source Repository: {0}'.format(args.source_repo))
     dbg('Destination Repository: {0}'.format(args.dest_repo))
@@ -140,7 +194,7 @@ def main(args):
     if args.clean:
         nfo('Performing \'clean\'...')
 
-        dest_repo = load_repo(args.dest_repo, args.release, args.arch)
+        dest_repo = load_repo(args.dest_repo, args.release, args.arch, primary_only=True, processes=args.jobs)
 
         for (rel, arches) in dest_repo.iteritems():
             for (arch, repo) in arches.iteritems():
@@ -164,7 +218,7 @@ def main(args):
     if args.update:
         nfo('Performing \'update\'...')
 
-        source_repo = load_repo(args.source_repo, args.release, args.arch)
+        source_repo = load_repo(args.source_repo, args.release, args.arch, processes=args.jobs)
 
         for (rel, arches) in source_repo.iteritems():
             for (arch, repo) in arches.iteritems():
@@ -187,23 +241,13 @@ def main(args):
                     staged_for_update[rel][arch] = local_update
                     dbg('Staged {0} packages for update from {1}'.format(len(local_update), os.path.join(rel, arch)))
 
-    if args.fast:
-        nfo('Performing magic speedups...')
+    if args.fast and staged_for_update:
+        nfo('Skipping packages which are unchanged in destination...')
 
-        speedups = 0
+        dest_repo = load_repo(args.dest_repo, args.release, args.arch, primary_only=True, processes=args.jobs)
 
-        for rel in staged_for_removal.keys():
-            if rel in staged_for_update:
-                for arch in staged_for_removal[rel].keys():
-                    if arch in staged_for_update[rel]:
-                        for pkg in staged_for_removal[rel][arch].keys():
-                            if pkg in staged_for_update[rel][arch]:
-                                if staged_for_removal[rel][arch][pkg].pkgId == staged_for_update[rel][arch][pkg].pkgId:
-                                    dbg('Package \'{0}\' is same in source and destination. Skipping...'.format(pkg))
-                                    speedups += 1
-                                    del staged_for_removal[rel][arch][pkg]
-                                    del staged_for_update[rel][arch][pkg]
-        nfo('Saved {0} deletions and copies'.format(speedups))
+        (skipped, saved) = skip_unchanged(args.dest_repo, dest_repo, staged_for_removal, staged_for_update)
+        nfo('Skipped {0} unchanged packages, avoiding {1} of copies'.format(skipped, format_size(saved)))
 
     if staged_for_removal:
         for rel in staged_for_removal.keys():
@@ -221,14 +265,16 @@ def main(args):
                 nfo('{0}Copying {1} packages to {2}'.format('' if args.commit else 'DRY-RUN: ', len(staged_for_update[rel][arch]), tgtpath))
                  # This system doesn't allow for duplicate package names. This is still, however, not the same as cleaning.
                 createrepo_updater.cr_remove_pkg(tgtpath, set(staged_for_update[rel][arch].keys()), remove_debuginfo=True, pkglist=None, perform_delete=args.commit, log=dbghandle)
-                createrepo_updater.cr_add_pkg(tgtpath, set(staged_for_update[rel][arch].values()), add_debuginfo=True, pkglist=None, perform_relocate=args.commit, copy=True, log=dbghandle)
+                createrepo_updater.cr_add_pkg(tgtpath, set(staged_for_update[rel][arch].values()), add_debuginfo=True, pkglist=None, perform_relocate=args.commit, copy=True, method='hardlink' if args.hardlink else 'reflink' if args.reflink else 'copy', log=dbghandle)
     elif args.update:
         nfo('No packages marked for update.')
 
     if args.verify_exist:
         nfo('Verifying packages in destination repo...')
 
-        dest_repo = load_repo(args.dest_repo, args.release, args.arch)
+        createrepo_updater.cr_wait_io(log=dbghandle)
+
+        dest_repo = load_repo(args.dest_repo, args.release, args.arch, primary_only=True, processes=args.jobs)
 
         for (rel, arches) in dest_repo.iteritems():
             for (arch, repo) in arches.iteritems():
@@ -271,7 +317,7 @@ def main(args):
 
     if args.commit:
         nfo('Flusing repodata...')
-        createrepo_updater.cr_flush_all_pkg_list(log=dbghandle)
+        createrepo_updater.cr_flush_all_pkg_list(processes=args.jobs, log=dbghandle)
 
     nfo('Repository operations complete.')
 
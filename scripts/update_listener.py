@@ -3,24 +3,39 @@ from argparse import ArgumentParser
 import os
 import sys
 import fcntl
+import multiprocessing
 import pyinotify
 import subprocess
 import StringIO
+import time
 import createrepo_updater
 
+from multiprocessing.pool import ThreadPool
+
 parser = ArgumentParser()
 
 parser.add_argument("--queue-path", dest="queue_path", default="/tmp/upload/queue.txt")
 parser.add_argument("--result-path", dest="result_path", default="result.txt")
+parser.add_argument("--batch-delay", dest="batch_delay", type=float, default=5.0,
+                    help="Seconds to keep collecting uploads after the first one is queued")
+parser.add_argument("--batch-size", dest="batch_size", type=int, default=100,
+                    help="Start processing once this many uploads are queued")
+parser.add_argument("--max-workers", dest="max_workers", type=int, default=4,
+                    help="Maximum number of destination repos processed concurrently")
 
 args = parser.parse_args()
 
+default_dest = '/mnt/storage/repos/smd-ros-building/fedora/linux'
+
 class QueueMonitor:
     wdd = None
 
-    def __init__(self, queue_path, result_path):
+    def __init__(self, queue_path, result_path, batch_delay=0, batch_size=None, max_workers=1):
         self.queue_path = queue_path
         self.result_path = result_path
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.max_workers = max_workers
 
         dirname = os.path.dirname(queue_path)
         if not os.path.exists(dirname):
@@ -43,9 +58,7 @@ class QueueMonitor:
         self.wdd = self.wm.add_watch(self.queue_path, pyinotify.IN_DELETE, rec=True)
         self.start_monitor()
 
-    def check_queue(self):
-        # Check for pendig
-        print('[%s] Checking queue...' % (createrepo_updater.stamp()))
+    def drain_queue(self):
         fcntl.lockf(self.fd, fcntl.LOCK_EX)
         self.stop_monitor()
         raw_queue = self.fd.read().strip()
@@ -53,33 +66,63 @@ class QueueMonitor:
         self.fd.truncate()
         self.start_monitor()
         fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        return [tuple(l.split(' ')) for l in raw_queue.split('\n') if l]
+
+    def check_queue(self):
+        # Check for pendig
+        print('[%s] Checking queue...' % (createrepo_updater.stamp()))
+        raw_queue = self.drain_queue()
+
+        # Give uploads arriving back to back a chance to share one metadata update
+        if raw_queue and self.batch_delay > 0:
+            deadline = time.time() + self.batch_delay
+            while (self.batch_size is None or len(raw_queue) < self.batch_size) and time.time() < deadline:
+                time.sleep(max(0, min(1.0, deadline - time.time())))
+                raw_queue += self.drain_queue()
+            print('[%s] Collected %d queued upload(s)' % (createrepo_updater.stamp(), len(raw_queue)))
+
         queue = {}
-        defqueue = []
-        raw_queue = [tuple(l.split(' ')) for l in raw_queue.split('\n') if l]
         if raw_queue:
             for q in raw_queue:
                 if len(q) > 2:
                     sys.stderr.write('[%s] Ignoring invalid entry: %s\n' % (createrepo_updater.stamp(), q))
                     continue
-                if len(q) == 1:
-                    defqueue.append(q[0])
-                else:
-                    if not q[1] in queue:
-                        queue[q[1]] = []
-                    queue[q[1]].append(q[0])
-            if defqueue:
-                self.process(defqueue)
-            for k in queue.keys():
-                self.process(queue[k], k)
+                # The same repo may be spelled differently
+                dest = os.path.normpath(os.path.abspath(q[1] if len(q) == 2 else default_dest))
+                if not dest in queue:
+                    queue[dest] = []
+                # A folder queued again counts as queued last
+                if q[0] in queue[dest]:
+                    queue[dest].remove(q[0])
+                queue[dest].append(q[0])
+
+            # Destinations are independent repos, so one slow repo doesn't
+            # hold up the others
+            if len(queue) > 1 and self.max_workers > 1:
+                workers = min(self.max_workers, len(queue))
+                # Share the cores between the workers' metadata pools
+                processes = max(1, multiprocessing.cpu_count() // workers)
+                pool = ThreadPool(workers)
+                try:
+                    pool.map(lambda k: self.process(queue[k], k, processes), queue.keys())
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for k in queue.keys():
+                    self.process(queue[k], k)
             print('[%s] Finished processing' % (createrepo_updater.stamp()))
         else:
             print('[%s] Queue is empty. Monitoring...' % (createrepo_updater.stamp()))
 
-    def process(self, files, dest=None):
+    def process(self, files, dest=None, processes=None):
         print('[%s] Processing %d upload(s) for %s...' % (createrepo_updater.stamp(), len(files), dest or 'default repo'))
         repo_path = ['--repo-path', dest] if dest else []
         if dest is None:
-            dest = '/mnt/storage/repos/smd-ros-building/fedora/linux'
+            dest = default_dest
+        # Only the repos below dest are touched here, other destinations may
+        # be in progress on other threads
+        dest_repos = lambda: [b for b in createrepo_updater.pkg_list_cache.keys() if b == dest or b.startswith(dest + os.sep)]
         file_args = []
         #for f in files:
         #    file_args += ['-f', f]
@@ -91,6 +134,10 @@ class QueueMonitor:
         #    sys.stderr.write('WARNING: Failed to process entry: %s\n' % (dest if dest else "default",))
         sio = StringIO.StringIO()
         try:
+            # Package lists stay cached between batches unless their repodata
+            # was changed by someone else in the meantime
+            createrepo_updater.cr_revalidate_pkg_lists(repo_bases=dest_repos(), log=sio)
+
             pkgs = {}
             for folder in files:
                 for root, dirs, dfiles in os.walk(folder):
@@ -101,10 +148,15 @@ class QueueMonitor:
                             sio.write('[%s] Determined that %s should go to %s\n' % (createrepo_updater.stamp(), os.path.basename(p.location_href), sr))
                             r = os.path.join(dest, sr)
                             if not r in pkgs:
-                                pkgs[r] = set()
-                            pkgs[r].add(p)
+                                pkgs[r] = {}
+                            # Only one package per name may be placed, so
+                            # the one queued last wins
+                            if p.name in pkgs[r]:
+                                sio.write('[%s] Skipping %s, superseded by %s\n' % (createrepo_updater.stamp(), pkgs[r][p.name].location_href, p.location_href))
+                            pkgs[r][p.name] = p
 
             for repo_base, packages in pkgs.items():
+                packages = set(packages.values())
                 package_names = set([p.name for p in packages])
                 for p in packages:
                     parch = p.arch
@@ -114,11 +166,18 @@ class QueueMonitor:
                 createrepo_updater.cr_remove_pkg(repo_base, package_names, log=sio)
                 createrepo_updater.cr_add_pkg(repo_base, packages, add_debuginfo=False, perform_relocate=True, copy=False, log=sio)
 
-            createrepo_updater.cr_flush_all_pkg_list(sio)
+            createrepo_updater.cr_flush_all_pkg_list(processes=processes, repo_bases=dest_repos(), log=sio)
 
             out = sio.getvalue()
         except Exception, e:
             out = 'FAILED\n%s%s' % (sio.getvalue(), e)
+            # The cached lists may not match the disk anymore, start over
+            for b in dest_repos():
+                try:
+                    createrepo_updater.cr_wait_io(b, log=sio)
+                except Exception:
+                    pass
+                createrepo_updater.cr_forget_pkg_list(b, log=sio)
             sys.stderr.write('[%s] WARNING: Failed to process entry: %s\n' % (createrepo_updater.stamp(), dest if dest else "default",))
         for d in files:
             try:
@@ -140,5 +199,5 @@ class QueueMonitor:
         self.notifier.loop()
    
 
-qmon = QueueMonitor(args.queue_path, args.result_path)
+qmon = QueueMonitor(args.queue_path, args.result_path, args.batch_delay, args.batch_size, args.max_workers)
 qmon.loop()
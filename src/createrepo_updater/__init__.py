@@ -1,34 +1,53 @@
+import bz2
+import cPickle
 import datetime
+import errno
+import fcntl
 import createrepo_c as cr
+import gzip
+import hashlib
 import multiprocessing
 import os
 import os.path
 import Queue
 import re
 import shutil
+import sqlite3
 import string
 import StringIO
 import sys
+import tempfile
+import threading
+import time
 
-class __ThreadableStringIO(StringIO.StringIO):
-    def __init__(self, *args, **kwargs):
-        StringIO.StringIO.__init__(self, *args, **kwargs)
-        self.queue = multiprocessing.Queue()
-        initstr = StringIO.StringIO.getvalue(self)
-        if initstr:
-            self.queue.put('%s' % (initstr,))
-    def write(self, s):
-        self.queue.put('%s' % (s,))
-    def getvalue(self, *args, **kwargs):
-        while True:
-            try:
-                StringIO.StringIO.write(self, self.queue.get_nowait())
-            except Queue.Empty:
-                break
-        return StringIO.StringIO.getvalue(self, *args, **kwargs)
+from multiprocessing.pool import ThreadPool
 
 pkg_list_cache = dict()
 pkg_list_cache_orig = dict()
+# Packages which were loaded from primary metadata only, per repo
+pkg_list_cache_shallow = dict()
+# Lookup tables over the cached package lists, see cr_get_pkg_index
+pkg_list_index = dict()
+# repomd.xml checksums each cached list was loaded from or last flushed to,
+# see cr_revalidate_pkg_lists
+pkg_list_cache_repomd = dict()
+
+# Number of package placements cr_add_pkg runs concurrently
+io_workers = 4
+
+# Parsed package lists are persisted here between runs, keyed by the metadata
+# checksums in repomd.xml. Set to None to disable.
+pkg_list_cache_dir = os.environ.get('CREATEREPO_UPDATER_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'createrepo_updater'))
+
+__pkg_attrs = [a for a in ['pkgId', 'name', 'arch', 'version', 'epoch',
+        'release', 'summary', 'description', 'url', 'time_file', 'time_build',
+        'rpm_license', 'rpm_vendor', 'rpm_group', 'rpm_buildhost',
+        'rpm_sourcerpm', 'rpm_header_start', 'rpm_header_end', 'rpm_packager',
+        'size_package', 'size_installed', 'size_archive', 'location_href',
+        'location_base', 'checksum_type', 'requires', 'provides', 'conflicts',
+        'obsoletes', 'suggests', 'enhances', 'recommends', 'supplements',
+        'files', 'changelogs'] if hasattr(cr.Package, a)]
 
 def stamp():
     return '%s' % (datetime.datetime.utcnow(),)
@@ -39,74 +58,385 @@ def cr_package_from_file(rpm_file, log=sys.stdout):
     np.location_href = rpm_file
     return np
 
-def cr_get_pkg_list(repo_base, log=sys.stdout):
+def cr_get_pkg_list(repo_base, primary_only=False, log=sys.stdout):
     if not repo_base in pkg_list_cache:
-        log.write('[%s] Parsing repodata from %s\n' % (stamp(), repo_base))
-        md = cr.Metadata()
         if not os.path.isfile(os.path.join(repo_base, 'repodata', 'repomd.xml')):
             raise Exception('Invalid repodata path: %s' % (repo_base,))
-        md.locate_and_load_xml(repo_base)
-        pkgs = set()
-        for key in md.keys():
-            pkgs.add(md.get(key))
-        pkg_list_cache[repo_base] = pkgs
-        pkg_list_cache_orig[repo_base] = pkg_list_cache[repo_base].copy()
+        shallow = False
+        # The snapshot holds full packages, loading it costs more than a shallow parse
+        pkgs = None if primary_only else cr_load_pkg_list_cache(repo_base, log)
+        if pkgs is not None:
+            pass
+        elif primary_only:
+            log.write('[%s] Parsing primary repodata from %s\n' % (stamp(), repo_base))
+            pkgs = set()
+            cr.xml_parse_primary(__repomd_locations(repo_base)['primary'], pkgcb=pkgs.add, do_files=False)
+            shallow = True
+        else:
+            log.write('[%s] Parsing repodata from %s\n' % (stamp(), repo_base))
+            md = cr.Metadata()
+            md.locate_and_load_xml(repo_base)
+            pkgs = set()
+            for key in md.keys():
+                pkgs.add(md.get(key))
+            cr_save_pkg_list_cache(repo_base, pkgs, log)
+        __set_pkg_list(repo_base, pkgs, shallow)
+    elif not primary_only and repo_base in pkg_list_cache_shallow:
+        log.write('[%s] Parsing remaining repodata from %s\n' % (stamp(), repo_base))
+        cr_fill_pkgs(os.path.join(repo_base, 'repodata'), pkg_list_cache_shallow.pop(repo_base).intersection(pkg_list_cache[repo_base]))
 
     return pkg_list_cache[repo_base]
 
-def cr_flush_all_pkg_list(log=sys.stdout):
-    log.write('[%s] Flushing all modified package lists to repodata\n' % (stamp(),))
-
-    tlog = __ThreadableStringIO()
-    th = []
-    for b in pkg_list_cache.keys():
-        th += [multiprocessing.Process(target=cr_flush_pkg_list, args=(b, pkg_list_cache[b], False, tlog))]
-    for t in th:
-        t.start()
-    for t in th:
-        t.join()
-    for b in pkg_list_cache.keys():
-        pkg_list_cache_orig[b] = pkg_list_cache[b].copy()
-    log.write(tlog.getvalue())
-
-def cr_flush_pkg_list(repo_base, pkglist=None, reset_orig=True, log=sys.stdout):
+def __set_pkg_list(repo_base, pkgs, shallow=False):
+    pkg_list_cache[repo_base] = pkgs
+    pkg_list_cache_orig[repo_base] = pkgs.copy()
+    pkg_list_cache_shallow.pop(repo_base, None)
+    if shallow:
+        pkg_list_cache_shallow[repo_base] = pkgs.copy()
+    pkg_list_index.pop(repo_base, None)
+    pkg_list_cache_repomd[repo_base] = __repomd_key(repo_base)
+
+def __repomd_key(repo_base):
+    try:
+        return __pkg_list_cache_key(repo_base)
+    except Exception:
+        return None
+
+def cr_forget_pkg_list(repo_base=None, log=sys.stdout):
+    # Drops the cached package list of repo_base, or all of them, so the next
+    # access parses the repodata again
+    if repo_base is None:
+        log.write('[%s] Dropping all cached package lists\n' % (stamp(),))
+        repo_bases = pkg_list_cache.keys()
+    else:
+        repo_bases = [repo_base]
+
+    for b in repo_bases:
+        for d in (pkg_list_cache, pkg_list_cache_orig, pkg_list_cache_shallow, pkg_list_index, pkg_list_cache_repomd):
+            d.pop(b, None)
+
+def cr_revalidate_pkg_lists(repo_bases=None, log=sys.stdout):
+    # Drops the cached package lists (all of them, or those of repo_bases)
+    # whose repodata was changed by someone else since they were loaded or
+    # last flushed. Long running processes call this before each batch to
+    # keep the rest of the cache warm.
+    if repo_bases is None:
+        repo_bases = pkg_list_cache.keys()
+    for b in repo_bases:
+        if not b in pkg_list_cache:
+            continue
+        if __repomd_key(b) != pkg_list_cache_repomd.get(b):
+            log.write('[%s] Repodata of %s changed, dropping cached package list\n' % (stamp(), b))
+            cr_forget_pkg_list(b, log)
+
+def __index_keys(p):
+    yield ('name', p.name)
+    yield ('nvra', p.nvra())
+    yield ('pkgId', p.pkgId)
+    for r in p.requires:
+        yield ('requires', r[0])
+
+def __index_pkgs(index, pkgs):
+    for p in pkgs:
+        for (t, k) in __index_keys(p):
+            index[t].setdefault(k, set()).add(p)
+
+def __unindex_pkgs(index, pkgs):
+    for p in pkgs:
+        for (t, k) in __index_keys(p):
+            if k in index[t]:
+                index[t][k].discard(p)
+                if not index[t][k]:
+                    del index[t][k]
+
+def cr_get_pkg_index(repo_base, pkglist=None, log=sys.stdout):
+    # Returns lookup tables over the package list:
+    #  - 'name': name -> packages
+    #  - 'nvra': name-version-release.arch -> packages
+    #  - 'pkgId': pkgId -> packages
+    #  - 'requires': required name -> packages requiring it
+    # The tables of a cached list are built once and then kept up to date by
+    # the functions in this module which add and remove packages.
+    if pkglist is None:
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
+
+    cached = pkglist is pkg_list_cache.get(repo_base)
+    if cached and repo_base in pkg_list_index:
+        return pkg_list_index[repo_base]
+
+    index = {'name': dict(), 'nvra': dict(), 'pkgId': dict(), 'requires': dict()}
+    __index_pkgs(index, pkglist)
+    if cached:
+        pkg_list_index[repo_base] = index
+    return index
+
+def __discard_pkgs(repo_base, pkglist, pkgs):
+    pkglist.difference_update(pkgs)
+    if pkglist is pkg_list_cache.get(repo_base) and repo_base in pkg_list_index:
+        __unindex_pkgs(pkg_list_index[repo_base], pkgs)
+
+def __insert_pkgs(repo_base, pkglist, pkgs):
+    pkglist.update(pkgs)
+    if pkglist is pkg_list_cache.get(repo_base) and repo_base in pkg_list_index:
+        __index_pkgs(pkg_list_index[repo_base], pkgs)
+
+def cr_refresh_pkg_list(repo_base, exclude=('debug',), pkglist=None, log=sys.stdout):
+    # Brings the package list in line with the RPMs found under repo_base (the
+    # top-level directories in exclude aside), the way createrepo --update does.
+    # Packages whose file is gone or differs in size or mtime are dropped, and
+    # only new or changed files have their header read.
+    # Returns the added and removed packages.
+    if pkglist is None:
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
+
+    on_disk = dict()
+    for (root, dirs, files) in os.walk(repo_base):
+        if root == repo_base:
+            dirs[:] = [d for d in dirs if d not in exclude and d not in ('repodata', '.repodata')]
+        for f in files:
+            if f.endswith('.rpm'):
+                path = os.path.join(root, f)
+                on_disk[os.path.relpath(path, repo_base)] = os.stat(path)
+
+    removed = set()
+    current = set()
+    for p in pkglist:
+        st = on_disk.get(p.location_href)
+        if st is None or st.st_size != p.size_package or int(st.st_mtime) != p.time_file:
+            removed.add(p)
+        else:
+            current.add(p.location_href)
+
+    added = set()
+    for href in sorted(set(on_disk.keys()) - current):
+        log.write('[%s] Loading information from %s\n' % (stamp(), os.path.join(repo_base, href)))
+        added.add(cr.package_from_rpm(os.path.join(repo_base, href), cr.SHA256, href, None, -1))
+
+    if removed:
+        log.write('[%s] Dropping %d missing or changed package(s) from %s\n' % (stamp(), len(removed), repo_base))
+    __discard_pkgs(repo_base, pkglist, removed)
+    __insert_pkgs(repo_base, pkglist, added)
+
+    return (added, removed)
+
+def __repomd_locations(repo_base):
+    ret = dict()
+    for r in cr.Repomd(os.path.join(repo_base, 'repodata', 'repomd.xml')).records:
+        ret[r.type] = os.path.join(repo_base, 'repodata', os.path.basename(r.location_href))
+    return ret
+
+def cr_fill_pkgs(repodata_path, pkgs, types=('filelists', 'other')):
+    # Completes packages which were parsed from primary metadata only with
+    # the files and changelogs from the metadata in repodata_path
+    pkgs = dict([(p.pkgId, p) for p in pkgs])
+    if not pkgs:
+        return
+
+    locations = __repomd_locations(os.path.dirname(repodata_path))
+    for t in types:
+        parse_func = cr.xml_parse_filelists if t == 'filelists' else cr.xml_parse_other
+        parse_func(locations[t], newpkgcb=lambda pkgId, name, arch: pkgs.get(pkgId))
+
+def __pkg_to_values(pkg):
+    return tuple([getattr(pkg, a) for a in __pkg_attrs])
+
+def __pkg_from_values(values):
+    pkg = cr.Package()
+    for (a, v) in zip(__pkg_attrs, values):
+        setattr(pkg, a, v)
+    return pkg
+
+def __load_task(args):
+    (repo_base, primary_only) = args
+    tlog = StringIO.StringIO()
+    try:
+        pkgs = cr_get_pkg_list(repo_base, primary_only=primary_only, log=tlog)
+        data = [__pkg_to_values(p) for p in pkgs]
+    except Exception, e:
+        return (repo_base, None, False, tlog.getvalue(), '%s' % (e,))
+    return (repo_base, data, repo_base in pkg_list_cache_shallow, tlog.getvalue(), None)
+
+def cr_get_all_pkg_list(repo_bases, primary_only=False, processes=None, log=sys.stdout):
+    # Parses all repos which aren't cached yet in parallel, then returns a map
+    # of repo_base to package list just like cr_get_pkg_list
+    todo = [b for b in set(repo_bases) if not b in pkg_list_cache]
+
+    if len(todo) > 1:
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(max(1, min(processes, len(todo))))
+        try:
+            for (repo_base, data, shallow, tlog, err) in pool.imap_unordered(__load_task, [(b, primary_only) for b in todo]):
+                log.write(tlog)
+                if err is not None:
+                    raise Exception('Failed to load %s: %s' % (repo_base, err))
+                __set_pkg_list(repo_base, set([__pkg_from_values(v) for v in data]), shallow)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    ret = dict()
+    for b in repo_bases:
+        ret[b] = cr_get_pkg_list(b, primary_only=primary_only, log=log)
+    return ret
+
+def __pkg_list_cache_key(repo_base):
+    checksums = dict()
+    for r in cr.Repomd(os.path.join(repo_base, 'repodata', 'repomd.xml')).records:
+        checksums[r.type] = r.checksum
+    return (__pkg_attrs, checksums.get('primary'), checksums.get('filelists'), checksums.get('other'))
+
+def __pkg_list_cache_path(repo_base):
+    return os.path.join(pkg_list_cache_dir, hashlib.sha1(os.path.abspath(repo_base)).hexdigest() + '.pickle')
+
+def cr_load_pkg_list_cache(repo_base, log=sys.stdout):
+    if pkg_list_cache_dir is None:
+        return None
+
+    try:
+        with open(__pkg_list_cache_path(repo_base), 'rb') as f:
+            (key, data) = cPickle.load(f)
+        if key != __pkg_list_cache_key(repo_base):
+            return None
+    except IOError:
+        return None
+    except Exception, e:
+        log.write('[%s] WARNING: Ignoring unreadable package list cache for %s (%s)\n' % (stamp(), repo_base, e))
+        return None
+
+    log.write('[%s] Loading cached package list for %s\n' % (stamp(), repo_base))
+    return set([__pkg_from_values(v) for v in data])
+
+def cr_save_pkg_list_cache(repo_base, pkgs, log=sys.stdout):
+    if pkg_list_cache_dir is None:
+        return
+
+    try:
+        if not os.path.isdir(pkg_list_cache_dir):
+            os.makedirs(pkg_list_cache_dir)
+        key = __pkg_list_cache_key(repo_base)
+        data = [__pkg_to_values(p) for p in pkgs]
+        (fd, tmp_path) = tempfile.mkstemp(dir=pkg_list_cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((key, data), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, __pkg_list_cache_path(repo_base))
+        except:
+            os.remove(tmp_path)
+            raise
+    except Exception, e:
+        log.write('[%s] WARNING: Failed to cache package list for %s (%s)\n' % (stamp(), repo_base, e))
+
+def cr_flush_all_pkg_list(incremental=True, processes=None, repo_bases=None, log=sys.stdout):
+    # Flushes every modified package list, or only those of repo_bases
+    wait_all = repo_bases is None
+    if wait_all:
+        log.write('[%s] Flushing all modified package lists to repodata\n' % (stamp(),))
+        repo_bases = pkg_list_cache.keys()
+    else:
+        log.write('[%s] Flushing modified package lists of %d repo(s) to repodata\n' % (stamp(), len(repo_bases)))
+        repo_bases = [b for b in repo_bases if b in pkg_list_cache]
+
+    pkglists = dict()
+    for b in repo_bases:
+        if pkg_list_cache[b] == pkg_list_cache_orig[b]:
+            log.write('[%s] Skipping flush for %s (no changes)\n' % (stamp(), b))
+            continue
+        pkglists[b] = pkg_list_cache[b]
+
+    __md_flush(pkglists, incremental, processes, True, log)
+
+    if wait_all:
+        cr_wait_io(log=log)
+    else:
+        for b in repo_bases:
+            cr_wait_io(b, log)
+
+def cr_flush_pkg_list(repo_base, pkglist=None, reset_orig=True, incremental=True, log=sys.stdout):
     if pkglist is None:
-        pkglist = cr_get_pkg_list(repo_base, log)
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
 
     if pkglist == pkg_list_cache_orig[repo_base]:
         log.write('[%s] Skipping flush for %s (no changes)\n' % (stamp(), repo_base))
         return
 
-    md_tmp = os.path.join(repo_base, '.repodata')
-    md_real = os.path.join(repo_base, 'repodata')
-
-    os.mkdir(md_tmp)
-    (repomd_data, data_files) = cr_create_md(md_tmp, pkglist, log)
-    cr_remove_old_md(md_real, 15, log)
-    cr_rename_data_files(md_real, data_files, log)
-    cr_write_repomd(md_real, repomd_data, log)
-    os.rmdir(md_tmp)
+    __md_flush({repo_base: pkglist}, incremental, None, reset_orig, log)
+
+def __md_flush(pkglists, incremental=True, processes=None, reset_orig=True, log=sys.stdout):
+    # Each repo is replaced on its own: one which fails keeps its old
+    # repodata while the others are still finalized, and all failures are
+    # raised together at the end
+    errors = dict()
+    jobs = dict()
+    for (repo_base, pkglist) in pkglists.items():
+        md_tmp = os.path.join(repo_base, '.repodata')
+        md_real = os.path.join(repo_base, 'repodata')
+        try:
+            os.mkdir(md_tmp)
+        except OSError, e:
+            errors[repo_base] = '%s' % (e,)
+            continue
+        shallow = pkg_list_cache_shallow.get(repo_base)
+        if shallow is not None:
+            shallow = (md_real, shallow.intersection(pkglist))
+        jobs[repo_base] = (md_tmp, md_real if incremental else None, pkglist, pkg_list_cache_orig.get(repo_base), shallow)
 
-    if reset_orig:
-        pkg_list_cache_orig[b] = pkg_list_cache[b]
+    try:
+        results = cr_run_md_jobs(jobs, processes, log, errors)
+    except:
+        for repo_base in jobs.keys():
+            shutil.rmtree(os.path.join(repo_base, '.repodata'), ignore_errors=True)
+        raise
+
+    for repo_base in jobs.keys():
+        md_tmp = os.path.join(repo_base, '.repodata')
+        md_real = os.path.join(repo_base, 'repodata')
+        if repo_base in errors:
+            shutil.rmtree(md_tmp, ignore_errors=True)
+            continue
+        try:
+            (repomd_data, data_files) = results[repo_base]
+            cr_wait_io(repo_base, log)
+            cr_remove_old_md(md_real, 15, log)
+            cr_rename_data_files(md_real, data_files, log)
+            cr_write_repomd(md_real, repomd_data, log)
+            os.rmdir(md_tmp)
+        except Exception, e:
+            errors[repo_base] = '%s' % (e,)
+            shutil.rmtree(md_tmp, ignore_errors=True)
+            continue
+        if reset_orig:
+            pkg_list_cache_orig[repo_base] = pkglists[repo_base].copy()
+        if repo_base in pkg_list_cache:
+            pkg_list_cache_repomd[repo_base] = __repomd_key(repo_base)
+        if not repo_base in pkg_list_cache_shallow:
+            cr_save_pkg_list_cache(repo_base, pkglists[repo_base], log)
+
+    if errors:
+        for (repo_base, err) in sorted(errors.items()):
+            log.write('[%s] ERROR: Failed to update repodata of %s: %s\n' % (stamp(), repo_base, err))
+        raise Exception('Failed to update repodata of %d repo(s): %s' % (len(errors), ', '.join(sorted(errors.keys()))))
 
 def cr_remove_downstream(repo_base, tbr, remove_debuginfo=True, pkglist=None, perform_delete=True, log=sys.stdout):
     if pkglist is None:
-        pkglist = cr_get_pkg_list(repo_base, log)
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
+
+    cr_wait_io(repo_base, log)
 
-    cache = {}
+    requires = cr_get_pkg_index(repo_base, pkglist, log)['requires']
 
     def __remove_downstream(tbr):
         deadlist = set()
-        for p in pkglist:
-            if not p.name in cache:
-                cache[p.name] = set([pr[0] for pr in p.requires])
-            if tbr.intersection(cache[p.name]):
-                deadlist.add(p)
+        for t in tbr:
+            deadlist.update(requires.get(t, ()))
+        deadlist.intersection_update(pkglist)
 
         if len(deadlist):
+            __discard_pkgs(repo_base, pkglist, deadlist)
             for p in deadlist:
-                pkglist.remove(p)
                 if perform_delete:
                     log.write('[%s] Removing dependant %s\n' % (stamp(), p.location_href))
                     try:
@@ -128,18 +458,22 @@ def cr_remove_downstream(repo_base, tbr, remove_debuginfo=True, pkglist=None, pe
 
 def cr_remove_pkg(repo_base, tbr, remove_debuginfo=True, pkglist=None, perform_delete=True, log=sys.stdout):
     if pkglist is None:
-        pkglist = cr_get_pkg_list(repo_base, log)
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
+
+    cr_wait_io(repo_base, log)
 
     if not hasattr(tbr, '__iter__'):
         tbr = set([tbr])
 
+    index = cr_get_pkg_index(repo_base, pkglist, log)
     deadlist = set()
-    for p in pkglist:
-        if p.name in tbr or p.nvra() in tbr:
-            deadlist.add(p)
+    for t in tbr:
+        deadlist.update(index['name'].get(t, ()))
+        deadlist.update(index['nvra'].get(t, ()))
+    deadlist.intersection_update(pkglist)
 
+    __discard_pkgs(repo_base, pkglist, deadlist)
     for p in deadlist:
-        pkglist.remove(p)
         if perform_delete:
             log.write('[%s] Specifically removing %s\n' % (stamp(), p.location_href))
             try:
@@ -163,45 +497,153 @@ def cr_try_remove_debuginfo(repo_base, tbr, perform_delete=True, log=sys.stdout)
     tbr = [t + '-debuginfo' for t in tbr]
 
     try:
-        pkglist = cr_get_pkg_list(repo_base, log)
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
     except: # TODO: Make this more specific to "doesn't exist"
         return
 
     return cr_remove_pkg(repo_base, tbr, False, pkglist, perform_delete, log)
 
-def cr_add_pkg(repo_base, pkgs, pkglist=None, add_debuginfo=True, perform_relocate=True, copy=False, log=sys.stdout):
+def cr_add_pkg(repo_base, pkgs, pkglist=None, add_debuginfo=True, perform_relocate=True, copy=False, method=None, log=sys.stdout):
     if pkglist is None:
-        pkglist = cr_get_pkg_list(repo_base, log)
+        pkglist = cr_get_pkg_list(repo_base, primary_only=True, log=log)
 
     if not hasattr(pkgs, '__iter__'):
         pkgs = set([pkgs])
 
+    if method is None:
+        method = 'copy' if copy else 'move'
+
     for pkg in pkgs:
         new_path = os.path.join(repo_base, os.path.basename(pkg.location_href))
         if not os.path.isfile(pkg.location_href):
             raise Exception('Target package does not exist or is not a file: %s' % (pkg.location_href,))
         if perform_relocate:
-            if copy:
-                log.write('[%s] Copying package %s to %s\n' % (stamp(), os.path.basename(pkg.location_href), repo_base))
-                shutil.copyfile(pkg.location_href, new_path)
-            else:
-                try:
-                    log.write('[%s] Relocating package %s to %s\n' % (stamp(), os.path.basename(pkg.location_href), repo_base))
-                    os.rename(pkg.location_href, new_path)
-                except OSError, e:
-                    if e.errno != 18:
-                        raise
-                    log.write('[%s] WARNING: Cross-device link detected for %s. Moving...\n' % (stamp(), os.path.basename(new_path)))
-                    shutil.move(pkg.location_href, new_path)
+            log.write('[%s] %s package %s to %s\n' % (stamp(), __place_verbs[method], os.path.basename(pkg.location_href), repo_base))
+            __io_submit(repo_base, pkg, new_path, method)
         else:
-            log.write('[%s] DRY-RUN: %s package %s to %s\n' % (stamp(), 'Copying' if copy else 'Relocating', os.path.basename(pkg.location_href), repo_base))
-        if add_debuginfo:
-            cr_try_add_debuginfo(repo_base, set([pkg]), perform_relocate, copy, log)
-        pkg.location_href = os.path.basename(new_path)
+            log.write('[%s] DRY-RUN: %s package %s to %s\n' % (stamp(), __place_verbs[method], os.path.basename(pkg.location_href), repo_base))
+    if add_debuginfo:
+        cr_try_add_debuginfo(repo_base, pkgs, perform_relocate, copy, method, log)
+    for pkg in pkgs:
+        pkg.location_href = os.path.basename(pkg.location_href)
     log.write('[%s] Adding %d packages to metadata\n' % (stamp(), len(pkgs)))
-    pkglist.update(pkgs)
+    __insert_pkgs(repo_base, pkglist, pkgs)
+
+__place_verbs = {
+    'move': 'Relocating',
+    'copy': 'Copying',
+    'hardlink': 'Hardlinking',
+    'reflink': 'Reflinking',
+}
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+def cr_place_file(src, dst, method='copy', log=sys.stdout):
+    # Places src at dst by one of the methods in __place_verbs. Links which
+    # the filesystem can't provide (across devices, no reflink support) fall
+    # back to a copy. Returns the method which was actually used.
+    if not method in __place_verbs:
+        raise ValueError('Unknown placement method: %s' % (method,))
+
+    if method == 'move':
+        try:
+            os.rename(src, dst)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            log.write('[%s] WARNING: Cross-device link detected for %s. Moving...\n' % (stamp(), os.path.basename(dst)))
+            shutil.move(src, dst)
+            return 'copy'
+        return 'move'
+
+    # Never write through an existing file, it might be linked to another repo
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if method == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError, e:
+            if not e.errno in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+            log.write('[%s] WARNING: Unable to hardlink %s (%s). Copying...\n' % (stamp(), os.path.basename(dst), e.strerror))
+    elif method == 'reflink':
+        try:
+            with open(src, 'rb') as fsrc:
+                with open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except IOError, e:
+            if not e.errno in [errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL]:
+                raise
+            log.write('[%s] WARNING: Unable to reflink %s (%s). Copying...\n' % (stamp(), os.path.basename(dst), e.strerror))
+
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+__io_pool = None
+__io_pending = dict()
+__io_lock = threading.Lock()
+
+def cr_verify_file(path, size=None, checksum_type=None, checksum=None):
+    st = os.stat(path)
+    if size is not None and st.st_size != size:
+        raise Exception('Size mismatch for %s: expected %d, got %d' % (path, size, st.st_size))
+
+    if checksum_type and checksum:
+        h = hashlib.new('sha1' if checksum_type == 'sha' else checksum_type)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                h.update(chunk)
+        if h.hexdigest() != checksum:
+            raise Exception('Checksum mismatch for %s: expected %s, got %s' % (path, checksum, h.hexdigest()))
+
+def __io_task(src, dst, method, size, checksum_type, checksum):
+    tlog = StringIO.StringIO()
+    try:
+        used = cr_place_file(src, dst, method, tlog)
+        # Moves and hardlinks keep the very same data, so only copies
+        # (including the fallbacks) are worth reading back
+        if used in ['move', 'hardlink']:
+            cr_verify_file(dst, size)
+        else:
+            cr_verify_file(dst, size, checksum_type, checksum)
+    except Exception, e:
+        return (dst, tlog.getvalue(), '%s' % (e,))
+    return (dst, tlog.getvalue(), None)
+
+def __io_submit(repo_base, pkg, dst, method):
+    global __io_pool
+    with __io_lock:
+        if __io_pool is None:
+            __io_pool = ThreadPool(max(1, io_workers))
+        res = __io_pool.apply_async(__io_task, (pkg.location_href, dst, method, pkg.size_package, pkg.checksum_type, pkg.pkgId))
+        __io_pending.setdefault(repo_base, []).append(res)
+
+def cr_wait_io(repo_base=None, log=sys.stdout):
+    # Waits for the package placements submitted by cr_add_pkg for repo_base,
+    # or for all repos, and raises if any of them failed
+    with __io_lock:
+        if repo_base is None:
+            pending = []
+            for b in __io_pending.keys():
+                pending += __io_pending.pop(b)
+        else:
+            pending = __io_pending.pop(repo_base, [])
+
+    errors = []
+    for res in pending:
+        (dst, tlog, err) = res.get()
+        log.write(tlog)
+        if err is not None:
+            errors += [err]
+
+    if errors:
+        raise Exception('Failed to place %d package(s):\n%s' % (len(errors), '\n'.join(errors)))
 
-def cr_try_add_debuginfo(repo_base, pkgs, perform_relocate=True, copy=False, log=sys.stdout):
+def cr_try_add_debuginfo(repo_base, pkgs, perform_relocate=True, copy=False, method=None, log=sys.stdout):
     if os.path.basename(os.path.dirname(repo_base + '/')) == 'debug':
         return
     repo_base = os.path.join(repo_base, 'debug')
@@ -209,115 +651,381 @@ def cr_try_add_debuginfo(repo_base, pkgs, perform_relocate=True, copy=False, log
     if not hasattr(pkgs, '__iter__'):
         pkgs = set([pkgs])
 
-    dbgpkgs = dict()
-
+    # Look up the counterparts of the whole batch in one pass per source repo
+    dbgnames = dict()
     for pkg in pkgs:
         dbg_repo_base = os.path.join(os.path.dirname(pkg.location_href), 'debug')
+        if not dbg_repo_base in dbgnames:
+            dbgnames[dbg_repo_base] = set()
+        dbgnames[dbg_repo_base].add(pkg.name + '-debuginfo')
+
+    dbgpkgs = set()
+
+    for (dbg_repo_base, names) in dbgnames.items():
         try:
-            dbg_pkglist = cr_get_pkg_list(dbg_repo_base, log)
+            dbg_pkglist = cr_get_pkg_list(dbg_repo_base, log=log)
         except: # TODO: Make this more specific to "doesn't exist"
             continue
 
-        this_dbginfo_name = pkg.name + '-debuginfo'
+        by_name = cr_get_pkg_index(dbg_repo_base, dbg_pkglist, log)['name']
 
-        found_dbgpkgs = [p.copy() for p in dbg_pkglist if p.name == this_dbginfo_name]
+        for name in names:
+            for p in by_name.get(name, ()):
+                dp = p.copy()
+                dp.location_href = os.path.join(dbg_repo_base, dp.location_href)
+                dbgpkgs.add(dp)
 
-        if not found_dbgpkgs:
-            continue
+    if dbgpkgs:
+        cr_add_pkg(repo_base, dbgpkgs, None, False, perform_relocate, copy, method, log)
 
-        for dp in found_dbgpkgs:
-            dp.location_href = os.path.join(dbg_repo_base, dp.location_href)
+def cr_create_md(repodata_path, pkglist=None, log=sys.stdout):
+    if pkglist is None:
+        pkglist = cr_get_pkg_list(repo_base, log=log)
 
-        if not dbg_repo_base in dbgpkgs:
-            dbgpkgs[dbg_repo_base] = set()
+    return cr_run_md_jobs({repodata_path: (repodata_path, None, pkglist, None, None)}, None, log)[repodata_path]
 
-        dbgpkgs[dbg_repo_base].update(found_dbgpkgs)
+__md_types = {
+    'primary': (cr.PrimaryXmlFile, cr.PrimarySqlite, cr.xml_dump_primary),
+    'filelists': (cr.FilelistsXmlFile, cr.FilelistsSqlite, cr.xml_dump_filelists),
+    'other': (cr.OtherXmlFile, cr.OtherSqlite, cr.xml_dump_other),
+}
 
-    for dbgpkg in dbgpkgs.values():
-        cr_add_pkg(repo_base, dbgpkg, None, False, perform_relocate, copy, log)
+# Package lists of the running cr_run_md_jobs calls. The pool workers are
+# forked after these are registered, so they read them copy-on-write instead
+# of having them pickled over.
+__md_jobs = dict()
 
-def cr_create_md(repodata_path, pkglist=None, log=sys.stdout):
-    if pkglist is None:
-        pkglist = cr_get_pkg_list(repo_base, log)
+def __md_create_xml(repodata_path, pkglist, name):
+    xml_path = os.path.join(repodata_path, name + '.xml.gz')
+
+    cs = cr.ContentStat(cr.SHA256)
+    xml = __md_types[name][0](xml_path, contentstat=cs)
+
+    xml.set_num_of_pkgs(len(pkglist))
+
+    for pkg in pkglist:
+        xml.add_pkg(pkg)
 
-    pri_xml_path = os.path.join(repodata_path, 'primary.xml.gz')
-    fil_xml_path = os.path.join(repodata_path, 'filelists.xml.gz')
-    oth_xml_path = os.path.join(repodata_path, 'other.xml.gz')
-    pri_db_path = os.path.join(repodata_path, 'primary.sqlite')
-    fil_db_path = os.path.join(repodata_path, 'filelists.sqlite')
-    oth_db_path = os.path.join(repodata_path, 'other.sqlite')
+    xml.close()
 
-    def __create_xml(queues, xml_path, xml_func, name):
-        cs = cr.ContentStat(cr.SHA256)
-        xml = xml_func(xml_path, contentstat=cs)
+    return ((name, xml_path), (cs.checksum, cs.size, cs.checksum_type))
 
-        xml.set_num_of_pkgs(len(pkglist))
+def __md_create_db(repodata_path, pkglist, name, checksum):
+    db_path = os.path.join(repodata_path, name + '.sqlite')
 
-        for pkg in pkglist:
-            xml.add_pkg(pkg)
+    db = __md_types[name][1](db_path)
 
-        xml.close()
+    for pkg in pkglist:
+        db.add_pkg(pkg)
 
-        queues['master'].put(((name, xml_path), (cs.checksum, cs.size, cs.checksum_type)), True)
+    db.dbinfo_update(checksum)
 
-    def __create_db(queues, db_path, db_func, name):
-        db = db_func(db_path)
+    db.close()
 
-        for pkg in pkglist:
-            db.add_pkg(pkg)
+    cs = cr.ContentStat(cr.SHA256)
+    cr.compress_file_with_stat(db_path, db_path + cr.compression_suffix(cr.BZ2_COMPRESSION), cr.BZ2_COMPRESSION, cs)
+    os.remove(db_path)
 
-        db.dbinfo_update(queues[name].get(True))
+    return ((name + '_db', db_path + cr.compression_suffix(cr.BZ2_COMPRESSION)), (cs.checksum, cs.size, cs.checksum_type))
+
+# Jobs whose shallow packages were already filled in this worker process
+__md_filled = set()
+
+def __md_task(key, task, arg=None):
+    (repodata_path, old_repodata_path, pkglist, orig_pkglist, shallow) = __md_jobs[key]
+    tlog = StringIO.StringIO()
+    try:
+        name = task[:-3] if task.endswith('_db') else task
+        # Shallow packages were parsed without any files, which primary needs
+        # too (for the file provides) and are taken from filelists
+        fill = 'filelists' if name == 'primary' else name
+        if task != 'update' and shallow is not None and not (key, fill) in __md_filled:
+            # This happens on the copy-on-write copy of the packages, so the
+            # parent never has to hold the files and changelogs
+            cr_fill_pkgs(shallow[0], shallow[1], (fill,))
+            __md_filled.add((key, fill))
+
+        if task == 'update':
+            res = cr_update_md(repodata_path, old_repodata_path, pkglist, orig_pkglist, tlog)
+        elif task.endswith('_db'):
+            res = __md_create_db(repodata_path, pkglist, task[:-3], arg)
+        else:
+            res = __md_create_xml(repodata_path, pkglist, task)
+    except Exception, e:
+        return (key, task, None, tlog.getvalue(), '%s' % (e,))
+    return (key, task, res, tlog.getvalue(), None)
+
+def cr_run_md_jobs(jobs, processes=None, log=sys.stdout, errors=None):
+    # jobs maps a key to (repodata_path, old_repodata_path, pkglist,
+    # orig_pkglist, shallow). An incremental update against old_repodata_path
+    # is tried first when both it and orig_pkglist are given. shallow is
+    # either None or a tuple of a repodata path and the packages which still
+    # need their files and changelogs filled from it. Returns a map of key to
+    # (repomd_data, data_files).
+    # When errors is given, a job which fails is recorded there by key and
+    # the other jobs carry on. Otherwise the failures are raised at the end.
+    if not jobs:
+        return dict()
+
+    failed = dict() if errors is None else errors
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, 6 * len(jobs)))
+
+    __md_jobs.update(jobs)
+    try:
+        pool = multiprocessing.Pool(processes)
+    except:
+        for key in jobs.keys():
+            del __md_jobs[key]
+        raise
 
-        db.close()
+    done = Queue.Queue()
+    state = {'pending': 0}
 
-        cs = cr.ContentStat(cr.SHA256)
-        cr.compress_file_with_stat(db_path, db_path + cr.compression_suffix(cr.BZ2_COMPRESSION), cr.BZ2_COMPRESSION, cs)
-        os.remove(db_path)
-        queues['master'].put(((name + '_db', db_path + cr.compression_suffix(cr.BZ2_COMPRESSION)), (cs.checksum, cs.size, cs.checksum_type)), True)
+    def __submit(key, task, arg=None):
+        state['pending'] += 1
+        pool.apply_async(__md_task, (key, task, arg), callback=done.put)
 
-    queue_manager = multiprocessing.Manager()
-    queues = dict({
-        'master':queue_manager.Queue(),
-        'primary':queue_manager.Queue(),
-        'filelists':queue_manager.Queue(),
-        'other':queue_manager.Queue(),
-	})
+    def __submit_full(key):
+        log.write('[%s] Generating metadata in %s\n' % (stamp(), jobs[key][0]))
+        for name in __md_types.keys():
+            __submit(key, name)
 
-    log.write('[%s] Generating metadata in %s\n' % (stamp(), repodata_path))
+    repomds = dict()
+    results = dict()
+    started = dict()
 
-    th = [0] * 6
-    th[0] = multiprocessing.Process(target=__create_xml, args=(queues, pri_xml_path, cr.PrimaryXmlFile, 'primary'))
-    th[0].start()
-    th[1] = multiprocessing.Process(target=__create_xml, args=(queues, fil_xml_path, cr.FilelistsXmlFile, 'filelists'))
-    th[1].start()
-    th[2] = multiprocessing.Process(target=__create_xml, args=(queues, oth_xml_path, cr.OtherXmlFile, 'other'))
-    th[2].start()
-    th[3] = multiprocessing.Process(target=__create_db, args=(queues, pri_db_path, cr.PrimarySqlite, 'primary'))
-    th[3].start()
-    th[4] = multiprocessing.Process(target=__create_db, args=(queues, fil_db_path, cr.FilelistsSqlite, 'filelists'))
-    th[4].start()
-    th[5] = multiprocessing.Process(target=__create_db, args=(queues, oth_db_path, cr.OtherSqlite, 'other'))
-    th[5].start()
+    def __finish(key, md):
+        results[key] = md
+        log.write('[%s] Finished metadata in %s after %.1fs\n' % (stamp(), jobs[key][0], time.time() - started[key]))
+
+    try:
+        # Start with the largest repos so the longest running jobs don't end
+        # up waiting behind the small ones
+        for key in sorted(jobs.keys(), key=lambda k: len(jobs[k][2]), reverse=True):
+            (repodata_path, old_repodata_path, pkglist, orig_pkglist, shallow) = jobs[key]
+            repomds[key] = (cr.Repomd(), set())
+            started[key] = time.time()
+            if old_repodata_path is not None and orig_pkglist is not None:
+                __submit(key, 'update')
+            else:
+                __submit_full(key)
+
+        def __handle(key, task, rf, err):
+            if task == 'update':
+                if rf is not None:
+                    __finish(key, rf)
+                    return
+                if err is not None:
+                    log.write('[%s] WARNING: Incremental update of %s failed (%s). Regenerating...\n' % (stamp(), jobs[key][1], err))
+                for f in os.listdir(jobs[key][0]):
+                    os.remove(os.path.join(jobs[key][0], f))
+                __submit_full(key)
+                return
+
+            if err is not None:
+                failed[key] = 'Failed to generate %s metadata in %s: %s' % (task, jobs[key][0], err)
+                return
+
+            (repomd, data_files) = repomds[key]
+            r = __md_record(*rf)
+            if not task.endswith('_db'):
+                __submit(key, task + '_db', r.checksum)
+            data_files.add(r.location_real)
+            repomd.set_record(r)
+
+            if len(data_files) == 2 * len(__md_types):
+                repomd.sort_records()
+                __finish(key, (repomd.xml_dump(), data_files))
+
+        while state['pending']:
+            (key, task, rf, tlog, err) = done.get(True)
+            state['pending'] -= 1
+            log.write(tlog)
+
+            if key in failed:
+                continue
+
+            # Whatever goes wrong here only concerns this one job
+            try:
+                __handle(key, task, rf, err)
+            except Exception, e:
+                failed[key] = 'Failed to generate %s metadata in %s: %s' % (task, jobs[key][0], e)
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for key in jobs.keys():
+            del __md_jobs[key]
+
+    if errors is None and failed:
+        raise Exception('\n'.join(failed.values()))
+
+    return results
+
+def __md_record(record, stat):
+    r = cr.RepomdRecord(*record)
+    r.checksum_open_type = cr.checksum_name_str(stat[2])
+    r.checksum_open = stat[0]
+    r.size_open = stat[1]
+    r.fill(cr.SHA256)
+    r.rename_file()
+    r.location_href = os.path.join('repodata', os.path.basename(r.location_href))
+    return r
+
+__md_pkg_start = re.compile(r'^\s*<package[\s>]')
+__md_pkg_count = re.compile(r'packages="\d+"')
+__md_pkg_ids = {
+    'primary': re.compile(r'<checksum type="[^"]*" pkgid="YES">([^<]+)</checksum>'),
+    'filelists': re.compile(r'<package pkgid="([^"]+)"'),
+    'other': re.compile(r'<package pkgid="([^"]+)"'),
+}
+
+def __md_open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    elif path.endswith('.xml'):
+        return open(path, 'rb')
+    raise Exception('Unsupported metadata compression: %s' % (path,))
+
+def __md_splice_xml(old_path, xml_path, name, dump_func, num_pkgs, removed_ids, added):
+    # Copy every package blob from the old metadata which wasn't removed, then
+    # append the new packages before the closing tag
+    cs = cr.ContentStat(cr.SHA256)
+    out = cr.CrFile(xml_path, cr.MODE_WRITE, cr.GZ_COMPRESSION, cs)
+
+    header = True
+    chunk = []
+    between = []
+    fd = __md_open(old_path)
+    try:
+        for line in fd:
+            if not chunk:
+                if __md_pkg_start.match(line):
+                    header = False
+                    for l in between:
+                        out.write(l)
+                    between = []
+                elif header:
+                    out.write(__md_pkg_count.sub('packages="%d"' % (num_pkgs,), line, 1))
+                    continue
+                else:
+                    between.append(line)
+                    continue
+            chunk.append(line)
+            if '</package>' in line:
+                blob = ''.join(chunk)
+                chunk = []
+                m = __md_pkg_ids[name].search(blob)
+                if not m:
+                    raise Exception('Could not determine pkgId of a package in %s' % (old_path,))
+                if not m.group(1) in removed_ids:
+                    out.write(blob)
+    finally:
+        fd.close()
+
+    if header or chunk:
+        raise Exception('Unexpected structure in %s' % (old_path,))
+
+    for pkg in added:
+        out.write(dump_func(pkg))
+    for l in between:
+        out.write(l)
+
+    out.close()
+
+    return ((name, xml_path), (cs.checksum, cs.size, cs.checksum_type))
+
+def __md_patch_db(old_path, db_path, db_func, name, checksum, removed_ids, added):
+    # Drop the removed packages from the old database, then merge in the rows
+    # of a database generated just for the added packages
+    cr.decompress_file(old_path, db_path, cr.AUTO_DETECT_COMPRESSION)
+
+    delta_path = db_path + '.delta'
+    db = db_func(delta_path)
+    for pkg in added:
+        db.add_pkg(pkg)
+    db.dbinfo_update(checksum)
+    db.close()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('ATTACH DATABASE ? AS delta', (delta_path,))
+        tables = []
+        for (t,) in conn.execute('SELECT name FROM main.sqlite_master WHERE type=\'table\'').fetchall():
+            if 'pkgKey' in [c[1] for c in conn.execute('PRAGMA main.table_info("%s")' % (t,)).fetchall()]:
+                tables += [t]
+        if not 'packages' in tables:
+            raise Exception('No packages table in %s' % (old_path,))
+        tables.remove('packages')
+
+        conn.execute('CREATE TEMP TABLE removed (pkgId TEXT PRIMARY KEY)')
+        conn.executemany('INSERT OR IGNORE INTO removed VALUES (?)', [(i,) for i in removed_ids])
+        for t in tables + ['packages']:
+            conn.execute('DELETE FROM main."%s" WHERE pkgKey IN (SELECT pkgKey FROM main.packages WHERE pkgId IN (SELECT pkgId FROM removed))' % (t,))
+
+        offset = conn.execute('SELECT IFNULL(MAX(pkgKey), 0) FROM main.packages').fetchone()[0]
+        for t in ['packages'] + tables:
+            cols = [c[1] for c in conn.execute('PRAGMA delta.table_info("%s")' % (t,)).fetchall()]
+            conn.execute('INSERT INTO main."%s" (%s) SELECT %s FROM delta."%s"' % (t,
+                ', '.join(['"%s"' % (c,) for c in cols]),
+                ', '.join(['pkgKey + %d' % (offset,) if c == 'pkgKey' else '"%s"' % (c,) for c in cols]),
+                t))
+
+        conn.execute('UPDATE main.db_info SET checksum = ?', (checksum,))
+        conn.commit()
+    finally:
+        conn.close()
+    os.remove(delta_path)
+
+    cs = cr.ContentStat(cr.SHA256)
+    cr.compress_file_with_stat(db_path, db_path + cr.compression_suffix(cr.BZ2_COMPRESSION), cr.BZ2_COMPRESSION, cs)
+    os.remove(db_path)
+
+    return ((name + '_db', db_path + cr.compression_suffix(cr.BZ2_COMPRESSION)), (cs.checksum, cs.size, cs.checksum_type))
+
+def cr_update_md(repodata_path, old_repodata_path, pkglist, orig_pkglist, log=sys.stdout):
+    added = pkglist - orig_pkglist
+    removed = orig_pkglist - pkglist
+
+    if len(added) + len(removed) > len(pkglist) / 2:
+        log.write('[%s] Too many changes for an incremental update of %s (%d added, %d removed)\n' % (stamp(), old_repodata_path, len(added), len(removed)))
+        return None
+
+    removed_ids = set([p.pkgId for p in removed])
+    if removed_ids.intersection([p.pkgId for p in pkglist if not p in added]):
+        log.write('[%s] Removed packages share a pkgId with remaining ones in %s\n' % (stamp(), old_repodata_path))
+        return None
+
+    old_files = dict()
+    for r in cr.Repomd(os.path.join(old_repodata_path, 'repomd.xml')).records:
+        old_files[r.type] = os.path.join(old_repodata_path, os.path.basename(r.location_href))
+
+    log.write('[%s] Updating metadata in %s (%d added, %d removed)\n' % (stamp(), repodata_path, len(added), len(removed)))
 
     repomd = cr.Repomd()
 
     data_files = set()
-    for i in range(0, 6):
-        rf = queues['master'].get(True)
-        r = cr.RepomdRecord(*rf[0])
-        r.checksum_open_type = cr.checksum_name_str(rf[1][2])
-        r.checksum_open = rf[1][0]
-        r.size_open = rf[1][1]
-        r.fill(cr.SHA256)
-        if not rf[0][0].endswith('_db'):
-            queues[rf[0][0]].put(r.checksum, True)
-        r.rename_file()
-        r.location_href = os.path.join('repodata', os.path.basename(r.location_href))
+    for (name, (xml_func, db_func, dump_func)) in __md_types.items():
+        if not name in old_files or not name + '_db' in old_files:
+            raise Exception('Missing %s metadata in %s' % (name, old_repodata_path))
+
+        rf = __md_splice_xml(old_files[name], os.path.join(repodata_path, name + '.xml.gz'), name, dump_func, len(pkglist), removed_ids, added)
+        r = __md_record(*rf)
         data_files.add(r.location_real)
         repomd.set_record(r)
 
-    for t in th:
-        t.join()
+        rf = __md_patch_db(old_files[name + '_db'], os.path.join(repodata_path, name + '.sqlite'), db_func, name, r.checksum, removed_ids, added)
+        r = __md_record(*rf)
+        data_files.add(r.location_real)
+        repomd.set_record(r)
 
     repomd.sort_records()
     return (repomd.xml_dump(), data_files)
@@ -1,68 +1,167 @@
-from bz2 import decompress as bz2_decompress
-from gzip import GzipFile
+from bz2 import BZ2Decompressor
+import cPickle
+import hashlib
+import httplib
 from xml.dom import minidom
+from xml.etree.cElementTree import iterparse
 import os
 import re
 import rpm
+import socket
 from urllib2 import urlopen
-from urlparse import urlparse
+from urlparse import urljoin, urlparse
 import sqlite3
-from StringIO import StringIO
 import struct
 import sys
-from tempfile import mktemp
-from threading import Thread
-
-ts = rpm.TransactionSet()
-# We really don't care about signatures...
-ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
-fver = re.compile('(.*)\.fc(\d+)')
-
-class RpmInfo:
-    name = None
-    version = None
-    release = None
-    is_src = None
-    arch = None
-    requires = None
-    provides = None
-    path = None
-    __fcdistro = None
-    __pkgrel = None
+from tempfile import mkstemp
+import threading
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Transaction sets can't be shared between threads, so each gets its own
+ts_local = threading.local()
+# Dist tags, including modular ones such as .module_f28+1234+abcdef01 or
+# .module_el8.1.0+2+fedcba98. The last one in the release wins.
+dist_re = re.compile('(.*)\.(fc|el|module_f|module_el)(\d+)')
+dist_names = {'fc': 'fc', 'el': 'el', 'module_f': 'fc', 'module_el': 'el'}
+common_ns = '{http://linux.duke.edu/metadata/common}'
+rpm_ns = '{http://linux.duke.edu/metadata/rpm}'
+
+# Decompressed metadata databases, keyed by the checksum in repomd.xml
+cache_dir = os.environ.get('RPMINFO_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'rpminfo'))
+cache_max_entries = 16
+
+# Bytes requested up front when fetching a remote package header, enough for
+# the header of most packages in a single round trip
+header_fetch_size = 0x10000
+# Keep-alive HTTP connections, one per server for each thread
+http_local = threading.local()
+
+# Headers of local packages, keyed by path and checked against size, mtime and
+# inode. Set header_cache to None to disable it. The table name carries the
+# format of the stored values, so entries of another format are never read.
+header_cache = os.path.join(cache_dir, 'headers.sqlite')
+header_cache_table = 'headers_v2'
+header_cache_fields = frozenset(['name', 'epoch', 'version', 'release', 'is_src', 'arch', 'requires', 'provides'])
+header_cache_max_entries = 20000
+header_cache_local = threading.local()
+
+# Parsed releases, as (distro, distver, pkgrel)
+releases = {}
+
+def parse_release(release):
+    if release not in releases:
+        distro = distver = pkgrel = None
+        m = dist_re.match(release) if release else None
+        if m:
+            distro = dist_names[m.group(2)]
+            distver = int(m.group(3))
+            # Not all releases are a plain number before the dist tag
+            if m.group(1).isdigit():
+                pkgrel = int(m.group(1))
+        releases[release] = (distro, distver, pkgrel)
+
+    return releases[release]
+
+
+# Group packages by their (distro, distver), (None, None) being those without
+# a recognised dist tag
+def classify_releases(pkgs):
+    classes = {}
+    for pkg in pkgs:
+        key = (pkg.distro, pkg.distver)
+        if key not in classes:
+            classes[key] = set()
+        classes[key].add(pkg)
+    return classes
+
+
+# Strings and dependency sets are shared between all packages, as the same few
+# thousand of them repeat across every repository
+interned = {}
+
+def intern_value(value):
+    if value is None:
+        return None
+    return interned.setdefault(value, value)
+
+
+def intern_deps(deps):
+    if deps is None:
+        return None
+    return intern_value(frozenset(intern_value(d) for d in deps))
+
+
+class RpmInfo(object):
+    __slots__ = ('name', 'epoch', 'version', 'release', 'is_src', 'arch',
+                 'requires', 'provides', 'path', 'distro', 'distver', 'pkgrel')
 
     def __init__(self, name = None, version = None, release = None,
                  is_src = None, arch = None, requires = None, provides = None,
-                 path = None):
-        self.name = name
-        self.version = version
-        self.release = release
+                 path = None, epoch = None):
+        self.name = intern_value(name)
+        self.epoch = intern_value(str(epoch) if epoch else '0')
+        self.version = intern_value(version)
+        self.release = intern_value(release)
         self.is_src = is_src
-        self.arch = arch
-        self.requires = requires
-        self.provides = provides
+        self.arch = intern_value(arch)
+        self.requires = intern_deps(requires)
+        self.provides = intern_deps(provides)
         self.path = path
+        self.distro, self.distver, self.pkgrel = parse_release(self.release)
 
     @property
-    def fcdistro(self):
-        if not self.__fcdistro:
-            try:
-                self.__pkgrel = int(re.match(fver, self.release).group(1))
-                self.__fcdistro = int(re.match(fver, self.release).group(2))
-            except:
-                pass
+    def nevra(self):
+        return (self.name, self.epoch, self.version, self.release, self.arch)
 
-        return self.__fcdistro
+    # The same package can sit at several paths (e.g. a noarch package uploaded
+    # for every arch), and each of those is placed on its own
+    def __key(self):
+        return (self.nevra, self.path)
 
-    @property
-    def pkgrel(self):
-        if not self.__pkgrel:
-            try:
-                self.__pkgrel = int(re.match(fver, self.release).group(1))
-                self.__fcdistro = int(re.match(fver, self.release).group(2))
-            except:
-                pass
+    def __eq__(self, other):
+        if not isinstance(other, RpmInfo):
+            return NotImplemented
+        return self.__key() == other.__key()
+
+    def __ne__(self, other):
+        if not isinstance(other, RpmInfo):
+            return NotImplemented
+        return self.__key() != other.__key()
+
+    def __hash__(self):
+        return hash(self.__key())
+
+    def __repr__(self):
+        return 'RpmInfo(%s-%s:%s-%s.%s)' % self.nevra
+
+    # Unpickled packages share the interned values of this process
+    def __getstate__(self):
+        return (self.name, self.version, self.release, self.is_src, self.arch,
+                self.requires, self.provides, self.path, self.epoch)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
 
-        return self.__pkgrel
+    @property
+    def fcdistro(self):
+        if self.distro == 'fc':
+            return self.distver
+        return None
 
     def has_requires(self, reqs):
         if not hasattr(reqs, '__iter__'):
@@ -77,92 +176,251 @@ class RpmInfo:
         return bool(any(i in self.provides for i in provs))
 
 
+def http_connection(url):
+    if not hasattr(http_local, 'conns'):
+        http_local.conns = {}
+    key = (url.scheme, url.netloc)
+    if key not in http_local.conns:
+        if url.scheme == 'https':
+            http_local.conns[key] = httplib.HTTPSConnection(url.netloc)
+        else:
+            http_local.conns[key] = httplib.HTTPConnection(url.netloc)
+    return http_local.conns[key]
+
+
+def http_close_connection(url):
+    conn = getattr(http_local, 'conns', {}).pop((url.scheme, url.netloc), None)
+    if conn:
+        conn.close()
+
+
+# Fetch bytes [start, end) of a remote file, reusing this thread's connection
+def http_read_range(url, start, end, redirects = 5):
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+
+    for attempt in xrange(2):
+        conn = http_connection(url)
+        try:
+            conn.request('GET', path, headers = {'Range': 'bytes=%d-%d' % (start, end - 1)})
+            resp = conn.getresponse()
+            if resp.status == 206:
+                return resp.read()
+            elif resp.status == 200:
+                # No range support, so take what's needed and drop the connection
+                buff = resp.read(end)
+                http_close_connection(url)
+                return buff[start:]
+            elif resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+                location = resp.getheader('Location')
+                resp.read()
+                return http_read_range(urlparse(urljoin(url.geturl(), location)), start, end, redirects - 1)
+            elif resp.status == 416:
+                # Asked past the end of the file
+                resp.read()
+                return ''
+            else:
+                resp.read()
+                raise IOError('HTTP error ' + str(resp.status) + ' fetching ' + url.geturl())
+        except (httplib.HTTPException, socket.error), ex:
+            # The server may have closed an idle connection, so retry once
+            http_close_connection(url)
+            if attempt:
+                raise IOError('Failed to fetch ' + url.geturl() + ': ' + str(ex))
+
+
+def read_header_from_url(init):
+    url = urlparse(init)
+    fdurl = None
+    if url.scheme in ['http', 'https']:
+        read_range = lambda start, end: http_read_range(url, start, end)
+    else:
+        # Anything else is read sequentially, which is all the parsing needs
+        fdurl = urlopen(init)
+        read_range = lambda start, end: fdurl.read(end - start)
+
+    try:
+        return read_header(read_range)
+    finally:
+        if fdurl:
+            fdurl.close()
+
+
+def read_header(read_range):
+    buff = read_range(0, header_fetch_size)
+
+    if len(buff) < 0x70 or buff[0:4] != '\xed\xab\xee\xdb':
+        raise rpm.error("error reading package header")
+
+    # The signature header follows the lead and is padded to 8 bytes
+    il, dl = struct.unpack(">ii", buff[0x68:0x70])
+    hdr_start = 0x70 + 0x10 * il + dl
+    hdr_start += ( 0x8 - ( hdr_start % 0x8 ) ) % 0x8
+    if len(buff) < hdr_start + 0x10:
+        buff += read_range(len(buff), hdr_start + 0x10)
+    if len(buff) < hdr_start + 0x10:
+        raise rpm.error("error reading package header")
+
+    # Then the header itself, which is all rpmlib needs
+    il, dl = struct.unpack(">ii", buff[hdr_start + 0x08:hdr_start + 0x10])
+    hdr_end = hdr_start + 0x10 + 0x10 * il + dl
+    if len(buff) < hdr_end:
+        buff += read_range(len(buff), hdr_end)
+    if len(buff) < hdr_end:
+        raise rpm.error("error reading package header")
+
+    return rpm.headerLoad(buff[hdr_start + 0x08:hdr_end])
+
+
+def header_cache_connection():
+    # Connections can't be shared across threads, nor survive a fork
+    if getattr(header_cache_local, 'pid', None) != os.getpid():
+        if not os.path.isdir(os.path.dirname(header_cache)):
+            os.makedirs(os.path.dirname(header_cache))
+        db = sqlite3.connect(header_cache, timeout = 30)
+        # Readers don't wait on writers, and losing the last few writes of a
+        # cache on power loss is fine
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, size INTEGER, '
+                   'mtime REAL, inode INTEGER, info BLOB, last_used REAL)' % header_cache_table)
+        db.execute('CREATE INDEX IF NOT EXISTS %s_last_used ON %s (last_used)' % (header_cache_table, header_cache_table))
+        db.commit()
+        header_cache_local.db = db
+        header_cache_local.pid = os.getpid()
+        header_cache_local.stores = 0
+        header_cache_local.touched = {}
+        header_cache_prune(db)
+    return header_cache_local.db
+
+
+# Hits are only remembered, and written in one transaction once enough of them
+# are collected or along with the next store
+def header_cache_touch(db, force = False):
+    touched = header_cache_local.touched
+    if touched and (force or len(touched) >= 0x100):
+        db.executemany('UPDATE %s SET last_used = ? WHERE path = ?' % header_cache_table,
+                       [(t, p) for (p, t) in touched.items()])
+        touched.clear()
+        return True
+    return False
+
+
+def header_cache_prune(db):
+    header_cache_touch(db, True)
+    db.execute('DELETE FROM %s WHERE path IN '
+               '(SELECT path FROM %s ORDER BY last_used DESC LIMIT -1 OFFSET ?)' % (header_cache_table, header_cache_table),
+               (header_cache_max_entries,))
+    db.commit()
+
+
+def header_cache_lookup(path, st):
+    try:
+        db = header_cache_connection()
+        row = db.execute('SELECT size, mtime, inode, info FROM %s WHERE path = ?' % header_cache_table, (path,)).fetchone()
+        if not row or tuple(row[:3]) != (st.st_size, st.st_mtime, st.st_ino):
+            return None
+        info = cPickle.loads(str(row[3]))
+        if not isinstance(info, dict) or frozenset(info.keys()) != header_cache_fields:
+            return None
+        header_cache_local.touched[path] = time.time()
+        if header_cache_touch(db):
+            db.commit()
+        return info
+    except Exception:
+        # Anything unreadable is just a miss
+        return None
+
+
+def header_cache_store(path, st, info):
+    try:
+        db = header_cache_connection()
+        header_cache_touch(db, True)
+        db.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)' % header_cache_table,
+                   (path, st.st_size, st.st_mtime, st.st_ino,
+                    sqlite3.Binary(cPickle.dumps(info, cPickle.HIGHEST_PROTOCOL)), time.time()))
+        db.commit()
+        header_cache_local.stores += 1
+        if header_cache_local.stores % 0x100 == 0:
+            header_cache_prune(db)
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def transaction_set():
+    if not hasattr(ts_local, 'ts'):
+        ts_local.ts = rpm.TransactionSet()
+        # We really don't care about signatures...
+        ts_local.ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+    return ts_local.ts
+
+
 def read_from_rpm(init):
+    cache_path = None
 
     if type(init) == str:
-        th = None
         url = urlparse(init)
         if url.scheme not in [None, '', 'file']:
-            fdno, fdno_w = os.pipe()
-            try:
-                fdurl = urlopen(init)
-                try:
-                    if fdurl.info()['Content-length'] < 0x70:
-                        raise rpm.error("error reading package header")
-                except KeyError:
-                    pass
-
-                # Read the magic
-                buff = fdurl.read(0x04)
-
-                if buff[0:4] != '\xed\xab\xee\xdb':
-                    raise rpm.error("error reading package header")
-
-                # Read the lead and the signature structure
-                buff += fdurl.read(0x6c)
-
-                # Read the signature and the header structure
-                tbr = 0x10 * struct.unpack(">i", buff[-8:-4])[0] + struct.unpack(">i", buff[-4:])[0]
-                tbr += 0x10 + ( 0x8 - (tbr % 0x8 ) ) % 0x8
-                buff += fdurl.read(tbr)
-
-                # Read the rest of the header
-                tbr = 0x10 * struct.unpack(">i", buff[-8:-4])[0] + struct.unpack(">i", buff[-4:])[0]
-                tbr += ( 0x8 - ( tbr % 0x8 ) ) % 0x8 + 100
-                buff += fdurl.read(tbr)
-                fdurl.close()
-
-                # If the pipe buffer fills, we'll block, so the pipe write needs to be threaded
-                th = Thread(target=os.write, args=(fdno_w, buff))
-                th.start()
-            except:
-                os.close(fdno)
-                raise
-            finally:
-                os.close(fdno_w)
+            hdr = read_header_from_url(init)
         else:
             fdno = os.open(url.netloc + url.path, os.O_RDONLY)
-        try:
-            hdr = ts.hdrFromFdno(fdno)
-        finally:
-            os.close(fdno)
-            if th:
-                th.join(1.0)
+            try:
+                if header_cache:
+                    cache_path = os.path.abspath(url.netloc + url.path)
+                    st = os.fstat(fdno)
+                    info = header_cache_lookup(cache_path, st)
+                    if info:
+                        return RpmInfo(path = init, **info)
+                hdr = transaction_set().hdrFromFdno(fdno)
+            finally:
+                os.close(fdno)
     elif type(init) == int:
-        hdr = ts.hdrFromFdno(init)
+        hdr = transaction_set().hdrFromFdno(init)
     elif type(init) == rpm.hdr:
         hdr = init
     else:
         raise TypeError('Could not initialize from type ' + str(type(init)))
 
-    return RpmInfo(name = hdr[rpm.RPMTAG_NAME],
-                   version = hdr[rpm.RPMTAG_VERSION],
-                   release = hdr[rpm.RPMTAG_RELEASE],
-                   is_src = not bool( hdr[rpm.RPMTAG_SOURCERPM] ),
-                   arch = hdr[rpm.RPMTAG_ARCH],
-                   requires = set(hdr[rpm.RPMTAG_REQUIRES]),
-                   provides = set(hdr[rpm.RPMTAG_PROVIDES]),
-                   path = init)
+    info = dict(name = hdr[rpm.RPMTAG_NAME],
+                epoch = hdr[rpm.RPMTAG_EPOCH],
+                version = hdr[rpm.RPMTAG_VERSION],
+                release = hdr[rpm.RPMTAG_RELEASE],
+                is_src = not bool( hdr[rpm.RPMTAG_SOURCERPM] ),
+                arch = hdr[rpm.RPMTAG_ARCH],
+                requires = hdr[rpm.RPMTAG_REQUIRES],
+                provides = hdr[rpm.RPMTAG_PROVIDES])
+
+    if cache_path:
+        header_cache_store(cache_path, st, info)
+
+    return RpmInfo(path = init, **info)
 
 
-def read_repository(repo_path):
+# With deps = False, requires and provides are left as None
+def read_repository(repo_path, deps = True):
     try:
-        return read_repository_sqlite(repo_path)
+        return read_repository_sqlite(repo_path, deps)
     except IOError:
-        return read_repository_xml(repo_path)
+        return read_repository_xml(repo_path, deps)
 
 
-def read_repository_xml(repo_path):
+def read_repository_xml(repo_path, deps = True):
     primary_xml = find_metadata_file(repo_path, 'primary')
-    return read_primary_xml(repo_path, primary_xml)
+    return read_primary_xml(repo_path, primary_xml, deps)
 
 
-def read_repository_sqlite(repo_path):
-    primary_sqlite = find_metadata_file(repo_path, 'primary_db')
-    return read_primary_sqlite(repo_path, primary_sqlite)
+def read_repository_sqlite(repo_path, deps = True):
+    primary_sqlite = find_metadata(repo_path, 'primary_db')
+    return read_primary_sqlite(repo_path, primary_sqlite['href'], deps,
+                               primary_sqlite['checksum_type'], primary_sqlite['checksum'])
 
 
 def find_metadata_file(repo_path, metadata = 'primary_db', repomd_xml = os.path.join('repodata', 'repomd.xml')):
+    return find_metadata(repo_path, metadata, repomd_xml)['href']
+
+
+def find_metadata(repo_path, metadata = 'primary_db', repomd_xml = os.path.join('repodata', 'repomd.xml')):
     repomd_xml = os.path.join(repo_path, repomd_xml)
     url = urlparse(repomd_xml)
     if url.scheme not in [None, '', 'file']:
@@ -173,116 +431,269 @@ def find_metadata_file(repo_path, metadata = 'primary_db', repomd_xml = os.path.
         repomd_data = minidom.parse(url.netloc + url.path).getElementsByTagName('data')
     for data_entry in repomd_data:
         if data_entry.getAttribute('type') == metadata:
-            return data_entry.getElementsByTagName('location')[0].getAttribute('href')
+            checksum_obj = data_entry.getElementsByTagName('checksum')
+            if checksum_obj:
+                checksum_type = checksum_obj[0].getAttribute('type')
+                checksum = checksum_obj[0].firstChild.data.strip()
+            else:
+                checksum_type = checksum = None
+            return {'href': data_entry.getElementsByTagName('location')[0].getAttribute('href'),
+                    'checksum_type': checksum_type,
+                    'checksum': checksum}
 
     raise IOError('Could not find metadata file \'' + metadata + '\'')
 
 
-def read_primary_xml(repo_path, primary_xml = os.path.join('repodata', 'primary.xml')):
-    primary_xml = os.path.join(repo_path, primary_xml)
-    url = urlparse(primary_xml)
+# Read-only file-like object decompressing another one on the fly, so streams
+# which can't seek (i.e. HTTP responses) never need to be held in memory
+class DecompressingReader:
+    def __init__(self, fd, decompressor, chunk_size = 0x10000):
+        self.fd = fd
+        self.decompressor = decompressor
+        self.chunk_size = chunk_size
+        self.buff = ''
+        self.eof = False
+
+    def read(self, size = -1):
+        while not self.eof and (size < 0 or len(self.buff) < size):
+            chunk = self.fd.read(self.chunk_size)
+            if chunk:
+                self.buff += self.decompressor.decompress(chunk)
+            else:
+                if hasattr(self.decompressor, 'flush'):
+                    self.buff += self.decompressor.flush()
+                self.eof = True
+
+        if size < 0:
+            ret, self.buff = self.buff, ''
+        else:
+            ret, self.buff = self.buff[:size], self.buff[size:]
+        return ret
+
+    def close(self):
+        self.fd.close()
+
+
+def get_decompressor(path):
+    if path.endswith('.gz'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif path.endswith('.bz2'):
+        return BZ2Decompressor()
+    elif path.endswith('.xz'):
+        if lzma is None:
+            raise IOError('No lzma module available to decompress ' + path)
+        return lzma.LZMADecompressor()
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise IOError('No zstandard module available to decompress ' + path)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return None
+
+
+def open_url(path):
+    url = urlparse(path)
     if url.scheme not in [None, '', 'file']:
-        fdurl = urlopen(primary_xml)
-        primary_xml_str = fdurl.read()
-        fdurl.close()
+        return urlopen(path)
 
-        if primary_xml.endswith('.gz'):
-            primary_xml_stream = StringIO(primary_xml_str)
-            primary_xml_gz = GzipFile(fileobj=primary_xml_stream, mode='rb')
-            primary_xml_str = primary_xml_gz.read()
+    return open(url.netloc + url.path, 'rb')
 
-        pkgdb = minidom.parseString(primary_xml_str)
-    else:
-        if primary_xml.endswith('.gz'):
-            primary_xml_gz = GzipFile(primary_xml, mode='rb')
-            primary_xml_str = primary_xml_gz.read()
-            pkgdb = minidom.parseString(primary_xml_str)
-        elif primary_xml.endswith('.xml'):
-            pkgdb = minidom.parse(primary_xml)
-
-    # Parse packages
-    pkgs = set()
-    for pkg in pkgdb.getElementsByTagName('package'):
-        if pkg.getAttribute('type') != 'rpm':
-            continue
-        rpm_name = pkg.getElementsByTagName('name')[0].firstChild.data
-        rpm_version_obj = pkg.getElementsByTagName('version')[0]
-        rpm_version = rpm_version_obj.getAttribute('ver')
-        rpm_release = rpm_version_obj.getAttribute('rel')
-        rpm_arch = pkg.getElementsByTagName('arch')[0].firstChild.data
+
+def open_metadata_file(path):
+    decompressor = get_decompressor(path)
+    fd = open_url(path)
+
+    if decompressor:
+        return DecompressingReader(fd, decompressor)
+
+    return fd
+
+
+# Copy a (possibly remote) metadata file into dst, decompressing it on the way
+# and verifying the checksum of the original, if given
+def fetch_metadata_file(path, dst, checksum_type = None, checksum = None):
+    decompressor = get_decompressor(path)
+    if checksum:
+        # repomd.xml calls SHA-1 'sha'
+        h = hashlib.new('sha1' if checksum_type == 'sha' else checksum_type)
+
+    fd = open_url(path)
+    try:
+        while True:
+            chunk = fd.read(0x10000)
+            if not chunk:
+                break
+            if checksum:
+                h.update(chunk)
+            dst.write(decompressor.decompress(chunk) if decompressor else chunk)
+        if hasattr(decompressor, 'flush'):
+            dst.write(decompressor.flush())
+    finally:
+        fd.close()
+
+    if checksum and h.hexdigest() != checksum:
+        raise IOError('Checksum mismatch for ' + path)
+
+
+# Returns the path of the decompressed copy in cache_dir, or None if the cache
+# can't be used
+def fetch_cached_metadata_file(path, checksum_type, checksum):
+    cached = os.path.join(cache_dir, 'primary_db-' + checksum + '.sqlite')
+    if os.path.exists(cached):
         try:
-            rpm_format_obj = pkg.getElementsByTagName('format')[0]
-        except (AttributeError, IndexError):
-            rpm_requires = rpm_provides = set()
-        else:
-            try:
-                rpm_requires_obj = rpm_format_obj.getElementsByTagName('rpm:requires')[0]
-                rpm_requires = set(r.getAttribute('name') for r in rpm_requires_obj.getElementsByTagName('rpm:entry'))
-            except (AttributeError, IndexError):
-                rpm_requires = set()
-            try:
-                rpm_provides_obj = rpm_format_obj.getElementsByTagName('rpm:provides')[0]
-                rpm_provides = set(p.getAttribute('name') for p in rpm_provides_obj.getElementsByTagName('rpm:entry'))
-            except (AttributeError, IndexError):
-                rpm_provides = set()
-        rpm_location_obj = pkg.getElementsByTagName('location')[0]
-        rpm_path = os.path.join(repo_path, rpm_location_obj.getAttribute('href'))
-        pkgs.add(RpmInfo(name = rpm_name,
-                         version = rpm_version,
-                         release = rpm_release,
-                         arch = rpm_arch,
-                         is_src = bool(rpm_arch == 'src'),
-                         requires = rpm_requires,
-                         provides = rpm_provides,
-                         path = rpm_path))
+            os.utime(cached, None)
+        except OSError:
+            pass
+        return cached
 
-    return pkgs
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fdno, cached_tmp = mkstemp(dir = cache_dir, suffix = '.tmp')
+    except OSError:
+        return None
+
+    try:
+        with os.fdopen(fdno, 'wb') as f:
+            fetch_metadata_file(path, f, checksum_type, checksum)
+        os.rename(cached_tmp, cached)
+    except:
+        os.remove(cached_tmp)
+        raise
+
+    prune_metadata_cache()
 
+    return cached
 
-def read_primary_sqlite(repo_path, primary_sqlite = os.path.join('repodata', 'primary.sqlite')):
+
+def prune_metadata_cache():
+    try:
+        # Only the decompressed databases, the header cache lives here too
+        entries = [os.path.join(cache_dir, e) for e in os.listdir(cache_dir)
+                   if e.startswith('primary_db-') and e.endswith('.sqlite')]
+        entries.sort(key = os.path.getmtime)
+        for entry in entries[:-cache_max_entries]:
+            os.remove(entry)
+    except OSError:
+        pass
+
+
+def iter_primary_xml(repo_path, primary_xml = os.path.join('repodata', 'primary.xml'), deps = True):
+    primary_xml = os.path.join(repo_path, primary_xml)
+    fd = open_metadata_file(primary_xml)
+
+    try:
+        root = None
+        for event, pkg in iterparse(fd, events = ('start', 'end')):
+            if root is None:
+                root = pkg
+            if event != 'end' or pkg.tag != common_ns + 'package':
+                continue
+
+            # Drop everything parsed so far, only this package is needed
+            root.clear()
+
+            if pkg.get('type') != 'rpm':
+                continue
+            rpm_name = pkg.findtext(common_ns + 'name')
+            rpm_version_obj = pkg.find(common_ns + 'version')
+            rpm_epoch = rpm_version_obj.get('epoch')
+            rpm_version = rpm_version_obj.get('ver')
+            rpm_release = rpm_version_obj.get('rel')
+            rpm_arch = pkg.findtext(common_ns + 'arch')
+            rpm_format_obj = pkg.find(common_ns + 'format')
+            if not deps:
+                rpm_requires = rpm_provides = None
+            elif rpm_format_obj is None:
+                rpm_requires = rpm_provides = set()
+            else:
+                rpm_requires = set(r.get('name') for r in rpm_format_obj.findall(rpm_ns + 'requires/' + rpm_ns + 'entry'))
+                rpm_provides = set(p.get('name') for p in rpm_format_obj.findall(rpm_ns + 'provides/' + rpm_ns + 'entry'))
+            rpm_location_obj = pkg.find(common_ns + 'location')
+            rpm_path = os.path.join(repo_path, rpm_location_obj.get('href'))
+            yield RpmInfo(name = rpm_name,
+                          version = rpm_version,
+                          release = rpm_release,
+                          arch = rpm_arch,
+                          is_src = bool(rpm_arch == 'src'),
+                          requires = rpm_requires,
+                          provides = rpm_provides,
+                          path = rpm_path,
+                          epoch = rpm_epoch)
+    finally:
+        fd.close()
+
+
+def read_primary_xml(repo_path, primary_xml = os.path.join('repodata', 'primary.xml'), deps = True):
+    return set(iter_primary_xml(repo_path, primary_xml, deps))
+
+
+def read_primary_sqlite_deps(cur, table):
+    deps = {}
+    cur.execute('SELECT pkgKey, name FROM ' + table)
+    for pkgkey, name in cur:
+        if pkgkey not in deps:
+            deps[pkgkey] = set()
+        deps[pkgkey].add(name)
+    return deps
+
+
+def read_primary_sqlite(repo_path, primary_sqlite = os.path.join('repodata', 'primary.sqlite'), deps = True,
+                        checksum_type = None, checksum = None):
     primary_sqlite = os.path.join(repo_path, primary_sqlite)
     primary_sqlite_tmp = None
     url = urlparse(primary_sqlite)
 
     if not primary_sqlite.endswith('.sqlite') or url.scheme not in [None, '', 'file']:
-        primary_sqlite_tmp = mktemp()
-        if url.scheme not in [None, '', 'file']:
-            fd = urlopen(primary_sqlite)
-        else:
-            fd = open(primary_sqlite, 'rb')
-        if primary_sqlite.endswith('.bz2'):
-            with open(primary_sqlite_tmp, 'wb') as f:
-                f.write(bz2_decompress(fd.read()))
+        primary_sqlite_cached = None
+        if checksum:
+            primary_sqlite_cached = fetch_cached_metadata_file(primary_sqlite, checksum_type, checksum)
+
+        if primary_sqlite_cached:
+            primary_sqlite = primary_sqlite_cached
         else:
-            with open(primary_sqlite_tmp, 'wb') as f:
-                f.write(fd.read())
-        fd.close()
+            fdno, primary_sqlite_tmp = mkstemp(suffix = '.sqlite')
+            try:
+                with os.fdopen(fdno, 'wb') as f:
+                    fetch_metadata_file(primary_sqlite, f, checksum_type, checksum)
+            except:
+                os.remove(primary_sqlite_tmp)
+                raise
 
-        primary_sqlite = primary_sqlite_tmp
-
-    pkgdb = sqlite3.connect(primary_sqlite)
-    cur = pkgdb.cursor()
-
-    # Parse packages
-    pkgs = set()
-    cur.execute('SELECT name, version, release, arch, location_href, pkgKey FROM packages')
-    for pkg in cur.fetchall():
-        cur.execute('SELECT name FROM requires WHERE pkgKey=' + str(pkg[5]))
-        req = set(r[0] for r in cur.fetchall())
-        cur.execute('SELECT name FROM provides WHERE pkgKey=' + str(pkg[5]))
-        prov = set(p[0] for p in cur.fetchall())
-        pkgs.add(RpmInfo(name = pkg[0],
-                         version = pkg[1],
-                         release = pkg[2],
-                         arch = pkg[3],
-                         is_src = bool(pkg[3] == 'src'),
-                         requires = req,
-                         provides = prov,
-                         path = pkg[4]))
-
-    pkgdb.close()
-
-    if primary_sqlite_tmp:
-        os.remove(primary_sqlite_tmp)
+            primary_sqlite = primary_sqlite_tmp
+
+    pkgdb = None
+    try:
+        pkgdb = sqlite3.connect(primary_sqlite)
+        cur = pkgdb.cursor()
+
+        # Fetch all dependencies up front rather than querying per package
+        if deps:
+            reqs = read_primary_sqlite_deps(cur, 'requires')
+            provs = read_primary_sqlite_deps(cur, 'provides')
+
+        # Parse packages
+        pkgs = set()
+        cur.execute('SELECT name, version, release, arch, location_href, pkgKey, epoch FROM packages')
+        for pkg in cur.fetchall():
+            if deps:
+                req = reqs.get(pkg[5], set())
+                prov = provs.get(pkg[5], set())
+            else:
+                req = prov = None
+            pkgs.add(RpmInfo(name = pkg[0],
+                             version = pkg[1],
+                             release = pkg[2],
+                             arch = pkg[3],
+                             is_src = bool(pkg[3] == 'src'),
+                             requires = req,
+                             provides = prov,
+                             path = pkg[4],
+                             epoch = pkg[6]))
+    finally:
+        if pkgdb is not None:
+            pkgdb.close()
+        if primary_sqlite_tmp:
+            os.remove(primary_sqlite_tmp)
 
     return pkgs
@@ -3,31 +3,10 @@ import fcntl
 import time
 import sys
 import shutil
-import createrepo
-import yum.misc
+import createrepo_updater
 import os
 import rpminfo
 
-# TODO: Cache this
-def make_cr_conf():
-    def_workers = os.nice(0)
-    if def_workers > 0:
-        def_workers = 1
-    else:
-        def_workers = 0
-
-    conf = createrepo.MetaDataConfig()
-    conf.excludes = ['debug/*']
-    conf.quiet = True
-    conf.checksum = yum.misc._default_checksums[0]
-    conf.database = True
-    conf.update = True
-    conf.retain_old_md = 15
-    conf.compress_type = 'compat'
-    conf.workers = def_workers
-    conf.split = True
-    return conf
-
 class LockContext:
     def __init__(self, lockfilename = None, timeout = 3000):
         if lockfilename:
@@ -114,21 +93,37 @@ def find_target_subrepos(repo_path, package, arch_hint = None):
         raise ValueError('No valid repository for ' + str(package.path))
     return set((candidate,))
 
-def update_metadata(repo_path):
+def update_metadata(repo_path, processes = None):
     if hasattr(repo_path, '__iter__'):
-        for repo in repo_path:
-            update_metadata(repo)
+        repos = sorted(set(repo_path))
+    else:
+        repos = [repo_path]
+    if not repos:
         return
 
-    conf = make_cr_conf()
-    conf.directory = repo_path
-    conf.directories = [repo_path]
+    # Only packages placed or removed since the last update are touched. The
+    # repos are regenerated together on one pool of at most processes
+    # workers, each being replaced only once its own metadata is complete.
+    createrepo_updater.cr_get_all_pkg_list(repos, primary_only = True, processes = processes)
+    errors = {}
+    for repo in repos:
+        print "Updating repository at " + repo
+        try:
+            createrepo_updater.cr_refresh_pkg_list(repo)
+        except Exception, e:
+            # Don't flush a half refreshed list, and let the next run reload it
+            errors[repo] = str(e)
+            createrepo_updater.cr_forget_pkg_list(repo)
+
+    try:
+        createrepo_updater.cr_flush_all_pkg_list(processes = processes,
+                                                 repo_bases = [r for r in repos if not r in errors])
+    except Exception, e:
+        errors[None] = str(e)
 
-    print "Updating repository at " + repo_path
-    mdgen = createrepo.SplitMetaDataGenerator(config_obj=conf)
-    mdgen.doPkgMetadata()
-    mdgen.doRepoMetadata()
-    mdgen.doFinalMove()
+    if errors:
+        raise Exception('Failed to update metadata:\n' +
+                        '\n'.join(str(e) if r is None else r + ': ' + e for (r, e) in sorted(errors.items())))
 
 def place_package(repo_path, package, delayed_metadata = None):
     md = set()
@@ -145,6 +140,17 @@ def place_package(repo_path, package, delayed_metadata = None):
     else:
         update_metadata(md)
 
+def read_cached(subrepo, cache, deps = True):
+    if subrepo not in cache:
+        cache[subrepo] = rpminfo.read_repository(subrepo, deps = deps)
+    elif deps:
+        pkg = next(iter(cache[subrepo]), None)
+        if pkg is not None and pkg.requires is None:
+            # Loaded without dependencies, reload but keep earlier removals
+            paths = set(p.path for p in cache[subrepo])
+            cache[subrepo] = set(p for p in rpminfo.read_repository(subrepo) if p.path in paths)
+    return cache[subrepo]
+
 def remove_package(repo_path, package, cache = None, delayed_metadata = None):
     if cache is None:
         cache = {}
@@ -154,10 +160,8 @@ def remove_package(repo_path, package, cache = None, delayed_metadata = None):
             remove_package(repo_path, pkg, cache = cache, delayed_metadata = md)
     else:
         for subrepo in find_target_subrepos(repo_path, package):
-            if subrepo not in cache:
-                cache[subrepo] = rpminfo.read_repository(subrepo)
             to_be_removed = set()
-            for pkg in cache[subrepo]:
+            for pkg in read_cached(subrepo, cache, deps = False):
                 if pkg.name == package.name:
                     to_be_removed.add(pkg)
 
@@ -177,14 +181,26 @@ def remove_package(repo_path, package, cache = None, delayed_metadata = None):
     else:
         update_metadata(md)
 
-# TODO: Thread this?
-def remove_dependent(repo_path, package, cache = None, delayed_metadata = None, arch_hint = None):
+def requires_index(subrepo, cache, rdeps):
+    if subrepo not in rdeps:
+        index = {}
+        for pkg in cache[subrepo]:
+            for req in pkg.requires:
+                if req not in index:
+                    index[req] = set()
+                index[req].add(pkg)
+        rdeps[subrepo] = index
+    return rdeps[subrepo]
+
+def remove_dependent(repo_path, package, cache = None, delayed_metadata = None, arch_hint = None, rdeps = None):
     if cache is None:
         cache = {}
+    if rdeps is None:
+        rdeps = {}
     md = set()
     if hasattr(package, '__iter__'):
         for pkg in package:
-            remove_dependent(repo_path, pkg, cache = cache, delayed_metadata = md)
+            remove_dependent(repo_path, pkg, cache = cache, delayed_metadata = md, rdeps = rdeps)
     else:
         if package.is_src or package.arch == 'src':
             return
@@ -192,15 +208,12 @@ def remove_dependent(repo_path, package, cache = None, delayed_metadata = None,
             arch_hint = determine_archdir(package)
         to_be_removed = set()
         for subrepo in find_target_subrepos(repo_path, package, arch_hint):
-            if subrepo not in cache:
-                cache[subrepo] = rpminfo.read_repository(subrepo)
-            for pkg in cache[subrepo]:
-                # Can't do this because it crosses rosdistros
-                #if package.provides.intersection(pkg.requires):
-                if package.name in pkg.requires:
-                    to_be_removed.add(pkg)
+            read_cached(subrepo, cache)
+            # Can't use package.provides because it crosses rosdistros
+            for pkg in requires_index(subrepo, cache, rdeps).get(package.name, ()):
+                to_be_removed.add((subrepo, pkg))
 
-        for pkg in to_be_removed:
+        for subrepo, pkg in to_be_removed:
             if pkg not in cache[subrepo]:
                 continue # Removed by recursive call
             pkgpath = os.path.join(subrepo, pkg.path)
@@ -211,7 +224,7 @@ def remove_dependent(repo_path, package, cache = None, delayed_metadata = None,
             cache[subrepo].remove(pkg)
             if not pkg.arch == 'noarch':
                 remove_debuginfo(subrepo, pkg.name, cache, md)
-            remove_dependent(repo_path, pkg, cache, md, arch_hint)
+            remove_dependent(repo_path, pkg, cache, md, arch_hint, rdeps)
 
     if delayed_metadata is not None:
         delayed_metadata |= md
@@ -229,11 +242,9 @@ def remove_debuginfo(subrepo, packagename, cache = None, delayed_metadata = None
         debugrepo = os.path.join(subrepo, 'debug')
         if not os.path.exists(os.path.join(debugrepo, 'repodata', 'repomd.xml')):
             return
-        if debugrepo not in cache:
-            cache[debugrepo] = rpminfo.read_repository(debugrepo)
         packagename += '-debuginfo'
         to_be_removed = set()
-        for pkg in cache[debugrepo]:
+        for pkg in read_cached(debugrepo, cache, deps = False):
             if pkg.name == packagename:
                 to_be_removed.add(pkg)
 